@@ -0,0 +1,385 @@
+import gc
+import sys
+import json
+import math
+import random
+import argparse
+import tracemalloc
+from time import perf_counter
+
+import numpy as np
+
+from objects_3d import *
+from scene_objects import *
+from lights import *
+from materials import *
+from loaders import loadMesh, getCachePath
+
+# How much slower a stage's median can get than the baseline before it counts as a regression
+REGRESSION_RATIO = 1.25
+# Stages faster than this many seconds are too noisy to flag
+REGRESSION_FLOOR = 0.0005
+
+PERCENTILES = (50, 90, 99)
+
+def makeMaterial(colour=[200, 200, 200]):
+    mat = Material()
+    mat.setShader('diffuse', DiffuseShader(list(colour)))
+    return mat
+
+def makeTexturedMaterial(size=256, squares=8):
+    '''
+    Make a material with a checkerboard texture
+    '''
+    image = pygame.Surface((size, size))
+    square = size//squares
+    for x in range(squares):
+        for y in range(squares):
+            image.fill((255, 0, 0) if (x+y)%2 else (255, 255, 0), (x*square, y*square, square, square))
+
+    mat = makeMaterial([255, 255, 255])
+    mat.shaders['diffuse'].setImage(image)
+    return mat
+
+def makeGrid(size, material, spacing=0.2, height=-2):
+    '''
+    Make an object holding a flat size x size grid of quads, the texture repeats once per quad
+    '''
+    obj = Object()
+    rows = [[Vertex(x*spacing-size*spacing/2, height, z*spacing+1, uv=[x, z]) for z in range(size+1)] for x in range(size+1)]
+    for x in range(size):
+        for z in range(size):
+            obj.addPolygon(Quad([rows[x][z], rows[x][z+1], rows[x+1][z+1], rows[x+1][z]], material, backCull=False))
+    obj.updateVertices()
+    return obj
+
+def makeFan(sides, material, radius=4, depth=8):
+    '''
+    Make an object holding one large N-Gon facing the camera
+    '''
+    obj = Object()
+    # Wind the points clockwise so the face isn't culled
+    angles = [-2*math.pi*a/sides for a in range(sides)]
+    obj.addPolygon(NGon([Vertex(radius*math.cos(a), radius*math.sin(a), depth) for a in angles], material))
+    obj.updateVertices()
+    return obj
+
+def makePointCube(material, size=4, centre=[0, 0, 12]):
+    '''
+    Make the cube of points from main.py, with the points on each side joined up into quads
+    '''
+    points = {}
+    for z in range(-size, size+1):
+        for y in range(-size, size+1):
+            for x in range(-size, size+1):
+                if abs(x) == size or abs(y) == size or abs(z) == size:
+                    points[(x, y, z)] = Vertex(x+centre[0], y+centre[1], z+centre[2])
+
+    obj = Object()
+    for axis in range(3):
+        for side in (-size, size):
+            for a in range(-size, size):
+                for b in range(-size, size):
+                    corners = []
+                    for da, db in ((0, 0), (0, 1), (1, 1), (1, 0)):
+                        key = [a+da, b+db]
+                        key.insert(axis, side)
+                        corners.append(points[tuple(key)])
+                    # Wind the far and near sides opposite ways so the normals point outwards
+                    obj.addPolygon(Quad(corners if side > 0 else corners[::-1], material))
+    obj.updateVertices()
+    return obj
+
+def makeInstances(count, material, seed=0):
+    '''
+    Make an instanced object scattering copies of one small cube from makePointCube, each turned and tinted randomly
+    '''
+    rand = random.Random(seed)
+    prop = makePointCube(material, size=1, centre=[0, 0, 0])
+    obj = InstancedObject(prop.mesh)
+    matrices = [getModelMatrix([rand.uniform(-15, 15), rand.uniform(-2, 4), rand.uniform(5, 30)], [rand.uniform(-math.pi, math.pi) for a in range(3)], 0.5)
+                for i in range(count)]
+    obj.setInstances(matrices, [[rand.randint(64, 255) for a in range(3)] for i in range(count)])
+    return obj
+
+def makeCrowd(count, material, seed=0, lods=True):
+    '''
+    Make a crowd of separate detailed cubes scattered into the distance, with levels of detail unless asked not to
+    '''
+    rand = random.Random(seed)
+    objects = []
+    for i in range(count):
+        obj = makePointCube(material, size=4, centre=[0, 0, 0])
+        obj.setTransform([rand.uniform(-12, 12), rand.uniform(-3, 3), rand.uniform(8, 19)], [rand.uniform(-math.pi, math.pi) for a in range(3)], 0.15)
+        if lods:
+            obj.generateLODs()
+        objects.append(obj)
+    return objects
+
+def makeWall(material, low, high, depth):
+    '''
+    Make an occluding wall facing the camera, from low to high across x and y
+    '''
+    obj = Object()
+    obj.addPolygon(Quad([Vertex(low[0], low[1], depth), Vertex(low[0], high[1], depth), Vertex(high[0], high[1], depth), Vertex(high[0], low[1], depth)], material, backCull=False))
+    obj.updateVertices()
+    obj.occluder = True
+    return obj
+
+def makeInterior(material):
+    '''
+    Make a wall with a doorway in it, hiding most of a crowd of cubes in the room behind it
+    '''
+    walls = [makeWall(material, [-20, -6], [-0.6, 6], 6), makeWall(material, [0.6, -6], [20, 6], 6),
+             makeWall(material, [-0.6, 1.2], [0.6, 6], 6)]
+    return walls+makeCrowd(60, material, lods=False)
+
+def makeLights(count, seed=0):
+    '''
+    Make a mix of randomly placed point lights and directional lights
+    '''
+    rand = random.Random(seed)
+    lights = []
+    for l in range(count):
+        if l%4 == 3:
+            light = DirectionalLight([rand.uniform(-math.pi, math.pi), rand.uniform(-1, 1)], 0.2)
+        else:
+            light = PointLight([rand.uniform(-10, 10), rand.uniform(0, 5), rand.uniform(0, 20)], rand.uniform(5, 30))
+        light.setColour([rand.randint(64, 255) for a in range(3)])
+        lights.append(light)
+    return lights
+
+def makeShadowLights(count, seed=0):
+    lights = makeLights(count, seed)
+    for light in lights:
+        light.setShadows(True)
+    return lights
+
+def makeScene(objects, lights):
+    scene = Scene()
+    for obj in objects:
+        scene.addObject(obj)
+    for light in lights:
+        scene.addLight(light)
+    return scene
+
+# Generated scenes, each one returns the scene and whether its lights move every frame
+SCENES = {
+    'grid': lambda: (makeScene([makeGrid(60, makeMaterial())], makeLights(1)), False),
+    'fan': lambda: (makeScene([makeFan(2000, makeMaterial())], makeLights(1)), False),
+    'pointCube': lambda: (makeScene([makePointCube(makeMaterial())], makeLights(1)), False),
+    'manyLights': lambda: (makeScene([makeGrid(30, makeMaterial())], makeLights(32)), True),
+    'textured': lambda: (makeScene([makeGrid(60, makeTexturedMaterial())], makeLights(1)), False),
+    'shadows': lambda: (makeScene([makeGrid(60, makeMaterial()), makeFan(200, makeMaterial())], makeShadowLights(4)), False),
+    'crowd': lambda: (makeScene(makeCrowd(60, makeMaterial()), makeLights(1)), False),
+    'interior': lambda: (makeScene(makeInterior(makeMaterial()), makeLights(1)), False),
+    'instances': lambda: (makeScene([makeInstances(400, makeMaterial())], makeLights(1)), False),
+}
+
+def runScene(scene, moveLights=False, frames=60, rasterMode=PAINTERS, workers=0, viewports=1, shadingMode=FLAT, renderMode=SHADED):
+    '''
+    Render frames of a scene with a slowly turning camera, split into side by side viewports if asked
+    Returns a dict of stage name to the seconds spent in it on each frame
+    '''
+    screen = pygame.Surface(SCREEN_SIZE)
+    width = SCREEN_SIZE[0]//viewports
+    cams = []
+    for v in range(viewports):
+        cam = Camera([0.1*v, 0, 0], [0, -0.1, 0], screen.subsurface((v*width, 0, width, SCREEN_SIZE[1])))
+        cam.setScene(scene)
+        cam.setRasterMode(rasterMode)
+        cam.setShadingMode(shadingMode)
+        cam.setRenderMode(renderMode)
+        cam.setWorkers(workers)
+        cams.append(cam)
+
+    times = {stage: [] for stage in STAGES+('total',)}
+    for frame in range(frames):
+        if moveLights:
+            # Force the lighting to be recalculated
+            scene.lights[0].pos[1] = 1+math.sin(frame)
+
+        screen.fill((255, 255, 255))
+        start = perf_counter()
+        for cam in cams:
+            cam.rot[0] = 0.3*math.sin(frame/frames*2*math.pi)
+            cam.preRender()
+            cam.renderScene()
+        times['total'].append(perf_counter()-start)
+
+        for stage in STAGES:
+            times[stage].append(sum(cam.stageTimes[stage] for cam in cams))
+
+    for cam in cams:
+        cam.close()
+    return times
+
+def summarise(times):
+    '''
+    Get the percentiles of each stage's frame times
+    '''
+    return {stage: {'p{}'.format(p): float(np.percentile(values, p)) for p in PERCENTILES}
+            for stage, values in times.items()}
+
+def runSuite(names=None, frames=60, rasterMode=PAINTERS, workers=0, viewports=1, shadingMode=FLAT, renderMode=SHADED):
+    '''
+    Run each of the named generated scenes, returning the summarised timings of every one
+    '''
+    results = {}
+    for name in names or SCENES:
+        scene, moveLights = SCENES[name]()
+        results[name] = summarise(runScene(scene, moveLights, frames, rasterMode, workers, viewports, shadingMode, renderMode))
+    return results
+
+def compare(results, baseline):
+    '''
+    Compare median stage times against a baseline
+    Returns a list of (scene, stage, baseline seconds, current seconds) for every regression
+    '''
+    regressions = []
+    for name, stages in results.items():
+        for stage, summary in stages.items():
+            old = baseline.get(name, {}).get(stage)
+            if old is None:
+                continue
+            if summary['p50'] > max(old['p50']*REGRESSION_RATIO, REGRESSION_FLOOR):
+                regressions.append((name, stage, old['p50'], summary['p50']))
+    return regressions
+
+def benchmarkLights(lightCounts=(1, 2, 4, 8, 16, 32, 64), size=50, repeats=3):
+    '''
+    Time lighting every face of a grid against increasing numbers of lights
+    Returns a list of (light count, per-face seconds, vectorised seconds)
+    '''
+    mat = makeMaterial()
+    mesh = makeGrid(size, mat).mesh
+
+    results = []
+    for count in lightCounts:
+        lights = makeLights(count)
+
+        # Only time the per-face path once, it is far slower
+        start = perf_counter()
+        for tri in mesh.triangles:
+            mat.getColour(tri, lights)
+        perFace = perf_counter()-start
+
+        start = perf_counter()
+        for r in range(repeats):
+            mat.getColours(mesh.globalCentres, mesh.globalNormals, lights)
+        vectorised = (perf_counter()-start)/repeats
+
+        results.append((count, perFace, vectorised))
+    return results
+
+def benchmarkLoad(path, repeats=3):
+    '''
+    Time loading a mesh file by parsing it, and by memory mapping the cache the first load writes
+    Returns the (parse seconds, cached seconds, triangle count)
+    '''
+    mat = makeMaterial()
+
+    start = perf_counter()
+    obj = loadMesh(path, mat, useCache=False)
+    parse = perf_counter()-start
+
+    # Make sure the cache is up to date before timing it
+    loadMesh(path, mat)
+    start = perf_counter()
+    for r in range(repeats):
+        loadMesh(path, mat)
+    cached = (perf_counter()-start)/repeats
+
+    return parse, cached, len(obj.mesh.faces)
+
+def benchmarkMemory(triangles=100000):
+    '''
+    Measure the memory held by a grid of quads with about the given number of triangles, before and after compacting it
+    Returns the bytes per 100k triangles of the Python objects and of the mesh's arrays, then the total once compacted
+    '''
+    size = int(math.sqrt(triangles/2))
+    mat = makeMaterial()
+
+    gc.collect()
+    tracemalloc.start()
+    obj = makeGrid(size, mat)
+    total = tracemalloc.get_traced_memory()[0]
+
+    obj.compact()
+    gc.collect()
+    compacted = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    # Some arrays are shared, so count each one once
+    arrays = sum(value.nbytes for value in {id(value): value for value in vars(obj.mesh).values() if isinstance(value, np.ndarray)}.values())
+    scale = 100000/len(obj.mesh.faces)
+    return (total-arrays)*scale, arrays*scale, compacted*scale
+
+def printResults(results):
+    for name, stages in results.items():
+        print(name)
+        print('  {:<10}'.format('Stage')+''.join('{:>10}'.format('p{} ms'.format(p)) for p in PERCENTILES))
+        for stage, summary in stages.items():
+            print('  {:<10}'.format(stage)+''.join('{:>10.2f}'.format(summary['p{}'.format(p)]*1000) for p in PERCENTILES))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the render engine on generated scenes.')
+    parser.add_argument('scenes', nargs='*', help='scenes to run out of {}, defaults to all of them'.format(', '.join(SCENES)))
+    parser.add_argument('--frames', type=int, default=60)
+    parser.add_argument('--zbuffer', action='store_true', help='use the Z_BUFFER raster mode')
+    parser.add_argument('--textured', action='store_true', help='use the TEXTURED render mode')
+    parser.add_argument('--wireframe', action='store_true', help='use the WIREFRAME_DOTS render mode')
+    parser.add_argument('--smooth', action='store_true', help='use SMOOTH_GOURAUD shading')
+    parser.add_argument('--workers', type=int, default=0, help='rasterise screen tiles in this many processes, implies --zbuffer')
+    parser.add_argument('--viewports', type=int, default=1, help='split the screen between this many cameras')
+    parser.add_argument('--save', help='save the results as a baseline JSON file')
+    parser.add_argument('--compare', help='compare the results against a baseline JSON file')
+    parser.add_argument('--lights', action='store_true', help='run the light-count scaling benchmark instead')
+    parser.add_argument('--load', help='time loading this OBJ or PLY file instead')
+    parser.add_argument('--memory', action='store_true', help='measure the memory used per 100k triangles instead')
+    args = parser.parse_args()
+
+    for name in args.scenes:
+        if name not in SCENES:
+            parser.error('unknown scene {}'.format(name))
+
+    if args.lights:
+        print('Lighting {} faces:'.format(2*50**2))
+        print('{:>7} {:>12} {:>12}'.format('Lights', 'Per-face ms', 'Batched ms'))
+        for count, perFace, vectorised in benchmarkLights():
+            print('{:>7} {:>12.2f} {:>12.2f}'.format(count, perFace*1000, vectorised*1000))
+        sys.exit()
+
+    if args.memory:
+        objects, arrays, compacted = benchmarkMemory()
+        print('Memory per 100k triangles:')
+        print('  Objects    {:>10.2f} MB'.format(objects/2**20))
+        print('  Arrays     {:>10.2f} MB'.format(arrays/2**20))
+        print('  Total      {:>10.2f} MB'.format((objects+arrays)/2**20))
+        print('  Compacted  {:>10.2f} MB'.format(compacted/2**20))
+        sys.exit()
+
+    if args.load:
+        parse, cached, triangles = benchmarkLoad(args.load)
+        print('Loading {} triangles from {}:'.format(triangles, args.load))
+        print('  Parsed     {:>10.2f} ms'.format(parse*1000))
+        print('  Cached     {:>10.2f} ms ({})'.format(cached*1000, getCachePath(args.load)))
+        sys.exit()
+
+    rasterMode = Z_BUFFER if args.zbuffer or args.workers else PAINTERS
+    shadingMode = SMOOTH_GOURAUD if args.smooth else FLAT
+    renderMode = TEXTURED if args.textured else WIREFRAME_DOTS if args.wireframe else SHADED
+    results = runSuite(args.scenes, args.frames, rasterMode, args.workers, args.viewports, shadingMode, renderMode)
+    printResults(results)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f))
+        for name, stage, old, new in regressions:
+            print('Regression in {} {}: {:.2f} ms -> {:.2f} ms'.format(name, stage, old*1000, new*1000))
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,149 @@
+import numpy as np
+
+def getClipPlanes(near, far, screenSize=None, cameraDepth=None):
+    '''
+    Get the (P, 3) normals and (P,) offsets of the clipping planes in camera space
+    A point p is inside a plane when dot(normal, p)+offset >= 0
+    The side planes are only included if the screen size and camera depth are given
+    '''
+    normals = [[0, 0, 1], [0, 0, -1]]
+    offsets = [-near, far]
+
+    if screenSize is not None:
+        # A point is on screen while |x| <= z*(width/2)/depth, and the same for y
+        slopeX = screenSize[0]/2/cameraDepth
+        slopeY = screenSize[1]/2/cameraDepth
+        normals += [[1, 0, slopeX], [-1, 0, slopeX], [0, 1, slopeY], [0, -1, slopeY]]
+        offsets += [0, 0, 0, 0]
+
+    return np.array(normals, dtype=float), np.array(offsets, dtype=float)
+
+def classifyFaces(corners, planes):
+    '''
+    Classify (M, 3, 3) face corners against the clipping planes
+    Returns whether each face is completely outside one of the planes, and whether it crosses any of them
+    '''
+    normals, offsets = planes
+    outside = (corners @ normals.T + offsets) < 0
+
+    rejected = outside.all(axis=1).any(axis=1)
+    crossing = outside.any(axis=(1, 2)) & ~rejected
+
+    return rejected, crossing
+
+def clipPolygons(points, planes):
+    '''
+    Clip (K, 3, C) triangles against every plane in turn with the Sutherland-Hodgman algorithm
+    The first three channels of each point are its position, any others are interpolated along with it
+    Returns the (K, N, C) clipped polygons and the number of points in each
+    '''
+    normals, offsets = planes
+    counts = np.full(len(points), points.shape[1])
+
+    for normal, offset in zip(normals, offsets):
+        n = points.shape[1]
+        index = np.arange(n)
+        exists = index < counts[:, None]
+
+        # Get the next point around each polygon
+        following = (index+1) % np.maximum(counts, 1)[:, None]
+        nextPoints = np.take_along_axis(points, following[:, :, None], axis=1)
+
+        dist = points[:, :, :3] @ normal + offset
+        nextDist = nextPoints[:, :, :3] @ normal + offset
+        inside = dist >= 0
+
+        # Every edge keeps its start point if it is inside, then adds where it crosses the plane
+        keep = exists & inside
+        crosses = exists & (inside != (nextDist >= 0))
+        ratio = dist/np.where(crosses, dist-nextDist, 1)
+        crossPoints = points + ratio[:, :, None]*(nextPoints-points)
+
+        candidates = np.stack([points, crossPoints], axis=2).reshape(len(points), 2*n, points.shape[2])
+        emit = np.stack([keep, crosses], axis=2).reshape(len(points), 2*n)
+
+        # Pack the emitted points to the start of each polygon
+        counts = emit.sum(axis=1)
+        slot = np.cumsum(emit, axis=1)-1
+        points = np.zeros((len(points), max(counts.max(initial=0), 3), candidates.shape[2]))
+        points[np.nonzero(emit)[0], slot[emit]] = candidates[emit]
+
+    return points, counts
+
+def triangulateFans(points, counts):
+    '''
+    Split clipped convex polygons back into triangles, fanning out from their first point
+    Returns the (T, 3, C) triangles, the polygon each came from and its position in the fan
+    '''
+    fanSize = np.maximum(counts-2, 0)
+    owner = np.repeat(np.arange(len(points)), fanSize)
+    fanIndex = np.arange(fanSize.sum()) - np.repeat(np.cumsum(fanSize)-fanSize, fanSize)
+
+    tris = np.stack([points[owner, 0], points[owner, fanIndex+1], points[owner, fanIndex+2]], axis=1)
+
+    return tris, owner, fanIndex
+
+def clipSegmentDepths(starts, ends, near, far):
+    '''
+    Clip (N, 3) camera space line segments to the part between the near and far planes
+    Returns the clipped starts and ends, and which segments are at least partly between the planes
+    '''
+    startDepth, endDepth = starts[:, 2], ends[:, 2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        toNear = (near-startDepth)/(endDepth-startDepth)
+        toFar = (far-startDepth)/(endDepth-startDepth)
+    enter = np.where(startDepth < near, toNear, 0)
+    leave = np.where(endDepth < near, toNear, 1)
+    enter = np.where(startDepth > far, np.maximum(enter, toFar), enter)
+    leave = np.where(endDepth > far, np.minimum(leave, toFar), leave)
+    inside = (enter <= leave) & (np.maximum(startDepth, endDepth) >= near) & (np.minimum(startDepth, endDepth) <= far)
+
+    delta = ends-starts
+    return starts+delta*enter[:, None], starts+delta*leave[:, None], inside
+
+def clipSegments(starts, ends, low, high):
+    '''
+    Clip (N, 2) line segments to the box from low to high
+    Returns the clipped starts and ends, and which segments are at least partly inside the box
+    '''
+    delta = ends-starts
+    enter = np.zeros(len(starts))
+    leave = np.ones(len(starts))
+    inside = np.ones(len(starts), dtype=bool)
+    for a in range(2):
+        # Each side keeps the part of the segment where step*t <= limit
+        for step, limit in ((-delta[:, a], starts[:, a]-low[a]), (delta[:, a], high[a]-starts[:, a])):
+            inside &= (step != 0) | (limit >= 0)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t = limit/step
+            enter = np.where(step < 0, np.maximum(enter, t), enter)
+            leave = np.where(step > 0, np.minimum(leave, t), leave)
+    inside &= enter <= leave
+    return starts+delta*enter[:, None], starts+delta*leave[:, None], inside
+
+class FaceBuffer:
+    '''
+    Reusable arrays holding the faces to draw each frame
+    They are only reallocated when a frame needs more room than any before it
+    '''
+    def __init__(self):
+        self.capacity = 0
+        self.size = 0
+        self._allocate(0)
+
+    def _allocate(self, capacity):
+        self.capacity = capacity
+        self.faces = np.zeros(capacity, dtype=int)
+        self.local = np.zeros((capacity, 3, 3))
+        self.screen = np.zeros((capacity, 3, 2), dtype=int)
+        self.depth = np.zeros(capacity)
+        self.colours = np.zeros((capacity, 3, 3))
+        self.uvs = np.zeros((capacity, 3, 2))
+
+    def resize(self, size):
+        '''
+        Set the number of faces in the buffer, growing it if needed
+        '''
+        if size > self.capacity:
+            self._allocate(max(size, 2*self.capacity))
+        self.size = size
@@ -0,0 +1,71 @@
+import numpy as np
+
+from objects_3d import Mesh
+
+# The fraction of a mesh's vertices kept by each level of detail made by decimateMesh
+DECIMATE_RATIO = 0.25
+# The most doublings of the grid size tried while looking for the right number of clusters
+# 2**21 cells along each side is the most which keeps the joined cell keys inside an int64
+DECIMATE_STEPS = 21
+
+def clusterVertices(positions, cells):
+    '''
+    Snap (N, 3) positions into a grid with the given number of cells along its longest side, at most 2**DECIMATE_STEPS
+    Returns the cluster index of every position and the number of clusters
+    '''
+    cells = min(cells, 2**DECIMATE_STEPS)
+    low = positions.min(axis=0)
+    extent = max((positions.max(axis=0)-low).max(), 1e-9)
+    grid = np.minimum(((positions-low)*(cells/extent)).astype(np.int64), cells-1)
+
+    # Join the three cell coordinates into one key per position
+    keys = (grid[:, 0]*cells+grid[:, 1])*cells+grid[:, 2]
+    unique, clusters = np.unique(keys, return_inverse=True)
+    return clusters.ravel(), len(unique)
+
+def decimateMesh(mesh, ratio=DECIMATE_RATIO):
+    '''
+    Make a simpler copy of a mesh with about the given fraction of its distinct vertex positions, by merging the vertices which share a cell of a grid
+    Faces which collapse to a line or point are dropped, the rest keep their materials, winding and culling
+    Returns a new Mesh built from arrays, the original is left alone
+    '''
+    mesh.getVersion()
+    positions = mesh.localPositions
+    simple = Mesh()
+    if not len(positions):
+        simple.setArrays(positions, mesh.faces, mesh.materials)
+        return simple
+
+    # Vertices at the same position would be welded by any grid, so only distinct positions count towards the target
+    target = max(int(len(np.unique(positions, axis=0))*ratio), 4)
+
+    # Find the finest grid which doesn't have more clusters than wanted, the count only grows with the cell count
+    low, high = 1, 2
+    while clusterVertices(positions, high)[1] <= target and high < 2**DECIMATE_STEPS:
+        low, high = high, high*2
+    if clusterVertices(positions, high)[1] <= target:
+        low = high
+    while high-low > 1:
+        middle = (low+high)//2
+        if clusterVertices(positions, middle)[1] <= target:
+            low = middle
+        else:
+            high = middle
+    clusters, count = clusterVertices(positions, low)
+
+    # Each cluster is placed at the average of the vertices merged into it
+    sizes = np.bincount(clusters, minlength=count)[:, None]
+    merged = np.stack([np.bincount(clusters, positions[:, a], count) for a in range(3)], axis=1)/sizes
+    uvs = np.stack([np.bincount(clusters, mesh.uvs[:, a], count) for a in range(2)], axis=1)/sizes
+
+    faces = clusters[mesh.faces]
+    valid = np.flatnonzero((faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 2] != faces[:, 0]))
+
+    # Faces merged onto the same three clusters are only kept once, rotated to start at their lowest index so the winding is kept
+    first = np.argmin(faces[valid], axis=1)
+    rotated = faces[valid[:, None], (first[:, None]+np.arange(3)) % 3]
+    kept = np.sort(np.unique(rotated, axis=0, return_index=True)[1]) if len(valid) else valid
+    faces, keep = rotated[kept], valid[kept]
+
+    simple.setArrays(merged, faces, mesh.materials, mesh.faceMaterials[keep], uvs, mesh.flipped[keep], mesh.backCull[keep], mesh.facePolygons[keep])
+    return simple
@@ -1,4 +1,5 @@
 import pygame
+import numpy as np
 
 import math
 from time import time
@@ -10,6 +11,7 @@ class PointLight:
         self.power = power
         self.pos = pos
         self.colour = [255, 255, 255]
+        self.castShadows = False
 
     def setBrightness(self, power):
         self.power = power
@@ -17,9 +19,21 @@ class PointLight:
     def setColour(self, colour):
         self.colour = colour
 
+    def setShadows(self, castShadows):
+        '''
+        Set whether objects block this light, which needs a shadow map to be rendered whenever the scene moves
+        '''
+        self.castShadows = castShadows
+
     def getPos(self, otherPos):
         return self.pos
 
+    def getState(self):
+        '''
+        Get a snapshot of everything that affects the light this gives off
+        '''
+        return (type(self), tuple(self.pos), self.power, tuple(self.colour), self.castShadows)
+
     def calculateFalloff(self, otherPos):
         '''
         Calculate the light level at a given position based on falloff
@@ -29,22 +43,51 @@ class PointLight:
             return 999999
         return self.power/(dist**2)
 
+    def getPositions(self, otherPoss):
+        '''
+        Get the position of the light as seen from each of an (N, 3) array of positions
+        '''
+        return np.broadcast_to(np.array(self.pos, dtype=float), np.shape(otherPoss))
+
+    def calculateFalloffs(self, otherPoss):
+        '''
+        Calculate the light level at each of an (N, 3) array of positions based on falloff
+        '''
+        dist = np.sqrt(((otherPoss-np.array(self.pos, dtype=float))**2).sum(axis=1))
+        return np.where(dist == 0, 999999, self.power/np.where(dist == 0, 1, dist)**2)
+
 class DirectionalLight(PointLight):
     def __init__(self, rot, power):
         super().__init__([0, 0, 0], power)
         self.rot = rot
 
-    def getPos(self, otherPos):
+    def getOffset(self):
+        '''
+        Get the offset from a lit position back towards the light
+        '''
         calcPos = [0, 0, 0]
 
         calcPos[0] = 10*math.cos(self.rot[0])
         calcPos[2] = 10*math.sin(self.rot[0])
         calcPos[1] = 10*math.tan(self.rot[1])
 
+        return calcPos
+
+    def getPos(self, otherPos):
+        calcPos = self.getOffset()
         return [otherPos[a]-calcPos[a] for a in range(3)]
 
+    def getPositions(self, otherPoss):
+        return otherPoss-np.array(self.getOffset())
+
+    def getState(self):
+        return super().getState()+(tuple(self.rot),)
+
     def calculateFalloff(self, otherPos):
         '''
         Return the light brightness because it's the same regardless of position
         '''
         return self.power
+
+    def calculateFalloffs(self, otherPoss):
+        return np.full(len(otherPoss), float(self.power))
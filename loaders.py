@@ -0,0 +1,469 @@
+import os
+import json
+import struct
+from itertools import islice
+
+import numpy as np
+
+from scene_objects import *
+
+# Bytes of a mesh file parsed at a time
+CHUNK_SIZE = 1 << 22
+# Added to the path of a mesh file to get the path of its cache
+CACHE_EXTENSION = '.rbmesh'
+# Written at the start of every cache file, change it whenever the layout changes
+CACHE_MAGIC = b'RBMESH2\n'
+# Every array in a cache file starts on a multiple of this many bytes, so it can be memory mapped in place
+CACHE_ALIGNMENT = 64
+# The type each array is stored as in a cache file
+CACHE_TYPES = {'positions': '<f4', 'faces': '<i4', 'uvs': '<f4', 'faceMaterials': '<i4', 'polygons': '<i4'}
+
+# The numpy type of each PLY property type
+PLY_TYPES = {'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1',
+             'short': 'i2', 'int16': 'i2', 'ushort': 'u2', 'uint16': 'u2',
+             'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+             'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8'}
+# The names used for texture coordinates in PLY files
+PLY_U = ('u', 's', 'texture_u', 'texture_s')
+PLY_V = ('v', 't', 'texture_v', 'texture_t')
+
+def loadMesh(path, material, materials=None, useCache=True):
+    '''
+    Load an OBJ or PLY file into a new Object, without making a Vertex or Triangle for any of it
+    Faces use the material their OBJ usemtl line names in the materials dict, or the given material otherwise
+    The first load writes a cache file next to the mesh, later loads memory map it instead of parsing the file again
+    '''
+    arrays = readCache(path) if useCache else None
+    if arrays is None:
+        extension = os.path.splitext(path)[1].lower()
+        if extension == '.obj':
+            arrays = readOBJ(path)
+        elif extension == '.ply':
+            arrays = readPLY(path)
+        else:
+            raise ValueError('Unsupported mesh file type {}.'.format(extension))
+
+        if useCache:
+            # The cache only speeds up later loads, so a folder which can't be written to still loads the mesh
+            try:
+                writeCache(path, arrays)
+            except OSError:
+                pass
+
+    materials = materials or {}
+    meshMaterials = [materials.get(name, material) for name in arrays['names']]
+
+    obj = Object()
+    obj.mesh.setArrays(arrays['positions'], arrays['faces'], meshMaterials, arrays['faceMaterials'], arrays['uvs'], polygons=arrays['polygons'])
+    return obj
+
+def readLines(file):
+    '''
+    Read a binary file in large blocks, yielding a list of the complete lines in each
+    '''
+    rest = b''
+    while True:
+        block = file.read(CHUNK_SIZE)
+        if not block:
+            if rest:
+                yield rest.splitlines()
+            return
+
+        block = rest+block
+        end = block.rfind(b'\n')+1
+        rest = block[end:]
+        yield block[:end].splitlines()
+
+def parseNumbers(lines):
+    '''
+    Parse lines of whitespace separated numbers into one flat array
+    '''
+    if not lines:
+        return np.zeros(0)
+    return np.fromstring(b' '.join(lines), sep=' ')
+
+def parseColumns(lines, columns):
+    '''
+    Parse the first few numbers of each line into a (len(lines), columns) array
+    '''
+    numbers = parseNumbers(lines)
+    if len(numbers) != len(lines)*columns:
+        # Some lines have extra values, like a w coordinate or a vertex colour
+        numbers = parseNumbers([b' '.join(line.split()[:columns]) for line in lines])
+    return numbers.reshape(-1, columns)
+
+def fanTriangles(counts):
+    '''
+    Split polygons with the given numbers of corners into triangles fanning out from their first corner
+    Returns the (T, 3) indices of the triangles' corners, counting through the corners of every polygon in order
+    '''
+    fanSize = np.maximum(counts-2, 0)
+    first = np.repeat(np.cumsum(counts)-counts, fanSize)
+    fanIndex = np.arange(fanSize.sum()) - np.repeat(np.cumsum(fanSize)-fanSize, fanSize)
+
+    return np.stack([first, first+fanIndex+1, first+fanIndex+2], axis=1)
+
+def fanPolygons(counts):
+    '''
+    Get the index of the polygon each triangle from fanTriangles came from
+    '''
+    return np.repeat(np.arange(len(counts)), np.maximum(counts-2, 0))
+
+def toEngineSpace(positions, uvs):
+    '''
+    Mesh files are right handed with texture coordinates starting at the bottom of the image
+    The engine is left handed with images starting at the top, so flip z and v
+    '''
+    positions[:, 2] *= -1
+    uvs[:, 1] = 1-uvs[:, 1]
+
+def readOBJ(path):
+    '''
+    Parse the vertices, texture coordinates and faces of an OBJ file in large blocks
+    Returns a dict of positions, faces, uvs, faceMaterials, polygons and the material names the faces index into
+    '''
+    positions = [np.zeros((0, 3))]
+    texCoords = [np.zeros((0, 2))]
+    corners = []
+    counts = []
+    faceMaterials = []
+
+    names = ['']
+    nameIndex = {'': 0}
+    current = 0
+    vCount = vtCount = 0
+
+    with open(path, 'rb') as file:
+        for lines in readLines(file):
+            vLines = []
+            vtLines = []
+            fLines = []
+            # Where each run of faces starts, and the number of vertices and texture coordinates before it
+            # Only needed for negative indices, which count back from the last vertex
+            runs = []
+            materialRuns = [(0, current)]
+
+            lastWasFace = False
+            for line in lines:
+                if line.startswith(b'v '):
+                    vLines.append(line[2:])
+                    lastWasFace = False
+                elif line.startswith(b'vt '):
+                    vtLines.append(line[3:])
+                    lastWasFace = False
+                elif line.startswith(b'f '):
+                    if not lastWasFace:
+                        runs.append((len(fLines), vCount+len(vLines), vtCount+len(vtLines)))
+                        lastWasFace = True
+                    fLines.append(line[2:])
+                elif line.startswith(b'usemtl '):
+                    name = line[7:].strip().decode()
+                    current = nameIndex.setdefault(name, len(names))
+                    if current == len(names):
+                        names.append(name)
+                    materialRuns.append((len(fLines), current))
+
+            positions.append(parseColumns(vLines, 3))
+            texCoords.append(parseColumns(vtLines, 2))
+
+            if fLines:
+                faceCorners, faceCounts = parseOBJFaces(fLines)
+
+                # Resolve negative indices against the counts before each run of faces
+                runStarts, runV, runVt = (np.array(a) for a in zip(*runs))
+                if (faceCorners < 0).any():
+                    run = np.repeat(np.searchsorted(runStarts, np.arange(len(fLines)), 'right')-1, faceCounts)
+                    faceCorners[:, 0] = np.where(faceCorners[:, 0] < 0, faceCorners[:, 0]+runV[run]+1, faceCorners[:, 0])
+                    faceCorners[:, 1] = np.where(faceCorners[:, 1] < 0, faceCorners[:, 1]+runVt[run]+1, faceCorners[:, 1])
+
+                matStarts, matIndex = (np.array(a) for a in zip(*materialRuns))
+                faceMaterials.append(matIndex[np.searchsorted(matStarts, np.arange(len(fLines)), 'right')-1])
+
+                corners.append(faceCorners)
+                counts.append(faceCounts)
+
+            vCount += len(vLines)
+            vtCount += len(vtLines)
+
+    positions = np.concatenate(positions)
+    texCoords = np.concatenate(texCoords)
+    corners = np.concatenate([np.zeros((0, 2), dtype=int)]+corners)
+    counts = np.concatenate([np.zeros(0, dtype=int)]+counts)
+    faceMaterials = np.concatenate([np.zeros(0, dtype=int)]+faceMaterials)
+
+    # OBJ indices start at 1, a texture coordinate of 0 means the corner doesn't have one
+    vertex = corners[:, 0]-1
+    texCoord = corners[:, 1]-1
+
+    tris = fanTriangles(counts)
+    faceMaterials = np.repeat(faceMaterials, np.maximum(counts-2, 0))
+
+    if len(texCoords):
+        # A vertex is needed for every pair of position and texture coordinate used together
+        pairs, cornerVertex = np.unique(vertex*(len(texCoords)+1)+texCoord+1, return_inverse=True)
+        pairVertex, pairTexCoord = pairs//(len(texCoords)+1), pairs%(len(texCoords)+1)-1
+
+        uvs = np.where((pairTexCoord >= 0)[:, None], texCoords[pairTexCoord], 0)
+        positions = positions[pairVertex]
+        faces = cornerVertex.ravel()[tris]
+    else:
+        uvs = np.zeros((len(positions), 2))
+        faces = vertex[tris]
+
+    toEngineSpace(positions, uvs)
+    return {'positions': positions, 'faces': faces, 'uvs': uvs, 'faceMaterials': faceMaterials, 'polygons': fanPolygons(counts), 'names': names}
+
+def parseOBJFaces(lines):
+    '''
+    Parse the corners of OBJ face lines, written as v, v/vt, v//vn or v/vt/vn
+    Returns the (C, 2) vertex and texture coordinate indices of every corner, and the number of corners in each face
+    '''
+    counts = np.array([len(line.split()) for line in lines])
+    text = b' '.join(lines).replace(b'//', b'/0/')
+
+    # Every corner of a file is nearly always written the same way, so parse them all at once
+    first = lines[0].split()[0].replace(b'//', b'/0/')
+    perCorner = first.count(b'/')+1
+    numbers = np.fromstring(text.replace(b'/', b' '), sep=' ').astype(int)
+
+    if len(numbers) != counts.sum()*perCorner:
+        # Corners are written in different ways, so parse them one at a time
+        values = []
+        for corner in text.split():
+            parts = corner.split(b'/')
+            values.append((int(parts[0]), int(parts[1] or 0) if len(parts) > 1 else 0))
+        return np.array(values, dtype=int).reshape(-1, 2), counts
+
+    numbers = numbers.reshape(-1, perCorner)
+    texCoords = numbers[:, 1] if perCorner > 1 else np.zeros(len(numbers), dtype=int)
+    return np.stack([numbers[:, 0], texCoords], axis=1), counts
+
+def readPLYHeader(file):
+    '''
+    Read the header of a PLY file
+    Returns the format and a list of (name, count, properties) for each element
+    Each property is (name, type), or (name, countType, itemType) for a list
+    '''
+    if file.readline().strip() != b'ply':
+        raise ValueError('Not a PLY file.')
+
+    fileFormat = None
+    elements = []
+    for line in file:
+        words = line.decode('ascii').split()
+        if not words or words[0] in ('comment', 'obj_info'):
+            continue
+        if words[0] == 'end_header':
+            break
+        if words[0] == 'format':
+            fileFormat = words[1]
+        elif words[0] == 'element':
+            elements.append((words[1], int(words[2]), []))
+        elif words[0] == 'property':
+            if words[1] == 'list':
+                elements[-1][2].append((words[4], PLY_TYPES[words[2]], PLY_TYPES[words[3]]))
+            else:
+                elements[-1][2].append((words[2], PLY_TYPES[words[1]]))
+
+    if fileFormat not in ('ascii', 'binary_little_endian', 'binary_big_endian'):
+        raise ValueError('Unsupported PLY format {}.'.format(fileFormat))
+    return fileFormat, elements
+
+def readPLYElement(file, fileFormat, count, properties):
+    '''
+    Read every item of one PLY element
+    Returns a dict of each property's (count,) values, or (count, N) values for a list property
+    Lists of different lengths are returned as a flat array of items along with the length of each list
+    '''
+    if not count:
+        return {prop[0]: np.zeros(0) for prop in properties}
+
+    if fileFormat == 'ascii':
+        lines = list(islice(file, count))
+        lists = [prop for prop in properties if len(prop) == 3]
+        numbers = parseNumbers(lines)
+        if not lists and len(numbers) == count*len(properties):
+            numbers = numbers.reshape(count, len(properties))
+            return {prop[0]: numbers[:, p] for p, prop in enumerate(properties)}
+
+        # Lists make each line a different length, so read the lines one at a time
+        values = {prop[0]: [] for prop in properties}
+        lengths = {prop[0]: [] for prop in lists}
+        for line in lines:
+            words = line.split()
+            w = 0
+            for prop in properties:
+                if len(prop) == 3:
+                    n = int(words[w])
+                    values[prop[0]] += words[w+1:w+1+n]
+                    lengths[prop[0]].append(n)
+                    w += n+1
+                else:
+                    values[prop[0]].append(words[w])
+                    w += 1
+        return packPLYLists(values, lengths, properties)
+
+    order = '<' if fileFormat == 'binary_little_endian' else '>'
+    lists = [prop for prop in properties if len(prop) == 3]
+    if not lists:
+        dtype = np.dtype([(prop[0], order+prop[1]) for prop in properties])
+        data = np.frombuffer(file.read(dtype.itemsize*count), dtype=dtype, count=count)
+        return {prop[0]: data[prop[0]] for prop in properties}
+
+    # Faces are nearly always all the same size, so try reading them as fixed size items first
+    start = file.tell()
+    lengths = []
+    for prop in properties:
+        if len(prop) == 3:
+            lengths.append(np.frombuffer(file.read(np.dtype(prop[1]).itemsize), dtype=order+prop[1])[0])
+            file.seek(np.dtype(prop[2]).itemsize*int(lengths[-1]), 1)
+        else:
+            file.seek(np.dtype(prop[1]).itemsize, 1)
+    file.seek(start)
+
+    fields = []
+    for prop in properties:
+        if len(prop) == 3:
+            fields += [(prop[0]+'_count', order+prop[1]), (prop[0], order+prop[2], (int(lengths.pop(0)),))]
+        else:
+            fields.append((prop[0], order+prop[1]))
+    dtype = np.dtype(fields)
+    block = file.read(dtype.itemsize*count)
+    if len(block) == dtype.itemsize*count:
+        data = np.frombuffer(block, dtype=dtype, count=count)
+        if all((data[prop[0]+'_count'] == data.dtype[prop[0]].shape[0]).all() for prop in lists):
+            return {prop[0]: data[prop[0]].reshape(count, -1) if len(prop) == 3 else data[prop[0]] for prop in properties}
+
+    # The lists are different lengths, so read the items one at a time
+    file.seek(start)
+    values = {prop[0]: [] for prop in properties}
+    lengths = {prop[0]: [] for prop in lists}
+    for i in range(count):
+        for prop in properties:
+            if len(prop) == 3:
+                countType, itemType = np.dtype(order+prop[1]), np.dtype(order+prop[2])
+                n = int(np.frombuffer(file.read(countType.itemsize), dtype=countType)[0])
+                values[prop[0]].append(np.frombuffer(file.read(itemType.itemsize*n), dtype=itemType))
+                lengths[prop[0]].append(n)
+            else:
+                itemType = np.dtype(order+prop[1])
+                values[prop[0]].append(np.frombuffer(file.read(itemType.itemsize), dtype=itemType))
+    return packPLYLists(values, lengths, properties)
+
+def packPLYLists(values, lengths, properties):
+    '''
+    Turn the values of a PLY element read one item at a time into arrays
+    '''
+    packed = {}
+    for prop in properties:
+        items = values[prop[0]]
+        items = np.concatenate(items) if items and isinstance(items[0], np.ndarray) else np.array(items, dtype=float)
+        packed[prop[0]] = items
+        if len(prop) == 3:
+            packed[prop[0]+'_lengths'] = np.array(lengths[prop[0]], dtype=int)
+    return packed
+
+def readPLY(path):
+    '''
+    Parse the vertices, texture coordinates and faces of an ASCII or binary PLY file
+    Returns a dict of positions, faces, uvs, faceMaterials, polygons and the material names the faces index into
+    '''
+    positions = np.zeros((0, 3))
+    uvs = None
+    faces = np.zeros((0, 3), dtype=int)
+    polygons = np.zeros(0, dtype=int)
+
+    with open(path, 'rb') as file:
+        fileFormat, elements = readPLYHeader(file)
+        for name, count, properties in elements:
+            values = readPLYElement(file, fileFormat, count, properties)
+            if name == 'vertex':
+                positions = np.stack([values['x'], values['y'], values['z']], axis=1).astype(float)
+                u = next((values[key] for key in PLY_U if key in values), None)
+                v = next((values[key] for key in PLY_V if key in values), None)
+                if u is not None and v is not None:
+                    uvs = np.stack([u, v], axis=1).astype(float)
+            elif name == 'face':
+                key = 'vertex_indices' if 'vertex_indices' in values else 'vertex_index'
+                indices = values[key].astype(int)
+                if key+'_lengths' in values:
+                    counts = values[key+'_lengths']
+                else:
+                    counts = np.full(len(indices), indices.shape[1] if indices.ndim == 2 else 0)
+                faces = indices.ravel()[fanTriangles(counts)]
+                polygons = fanPolygons(counts)
+
+    if uvs is None:
+        uvs = np.zeros((len(positions), 2))
+
+    toEngineSpace(positions, uvs)
+    return {'positions': positions, 'faces': faces, 'uvs': uvs, 'faceMaterials': np.zeros(len(faces), dtype=int), 'polygons': polygons, 'names': ['']}
+
+def getCachePath(path):
+    return path+CACHE_EXTENSION
+
+def getSourceKey(path):
+    '''
+    Get the size and modification time of a mesh file, a cache is out of date if they change
+    '''
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def writeCache(path, arrays):
+    '''
+    Write the arrays of a parsed mesh to its cache file
+    The file is a JSON header describing each array, followed by the raw arrays
+    '''
+    layout = {}
+    offset = 0
+    for name, dtype in CACHE_TYPES.items():
+        array = np.ascontiguousarray(arrays[name], dtype=dtype)
+        layout[name] = (array, offset)
+        offset += -(-array.nbytes//CACHE_ALIGNMENT)*CACHE_ALIGNMENT
+
+    header = json.dumps({'source': getSourceKey(path),
+                         'names': arrays['names'],
+                         'arrays': {name: [array.dtype.str, array.shape, offset] for name, (array, offset) in layout.items()}
+                         }).encode()
+    dataStart = -(-(len(CACHE_MAGIC)+8+len(header))//CACHE_ALIGNMENT)*CACHE_ALIGNMENT
+
+    # Write to a temporary file first, so a cache is never left half written
+    cachePath = getCachePath(path)
+    with open(cachePath+'.tmp', 'wb') as file:
+        file.write(CACHE_MAGIC)
+        file.write(struct.pack('<Q', len(header)))
+        file.write(header)
+        for name, (array, offset) in layout.items():
+            file.seek(dataStart+offset)
+            file.write(array.tobytes())
+    os.replace(cachePath+'.tmp', cachePath)
+
+def readCache(path):
+    '''
+    Memory map the arrays of a mesh's cache file
+    Returns None if there is no cache, or if the mesh file has changed since it was written
+    '''
+    cachePath = getCachePath(path)
+    if not os.path.exists(cachePath):
+        return None
+
+    with open(cachePath, 'rb') as file:
+        if file.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+            return None
+        headerSize = struct.unpack('<Q', file.read(8))[0]
+        header = json.loads(file.read(headerSize))
+
+    # A cache can be used without the file it came from, but not once that file has changed
+    if os.path.exists(path) and header['source'] != getSourceKey(path):
+        return None
+
+    dataStart = -(-(len(CACHE_MAGIC)+8+headerSize)//CACHE_ALIGNMENT)*CACHE_ALIGNMENT
+    # Copy on write, so changing a mesh's arrays in place never changes the cache
+    data = np.memmap(cachePath, dtype=np.uint8, mode='c')
+
+    arrays = {'names': header['names']}
+    for name, (dtype, shape, offset) in header['arrays'].items():
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape))*dtype.itemsize
+        arrays[name] = data[dataStart+offset:dataStart+offset+size].view(dtype).reshape(shape)
+    return arrays
@@ -1,3 +1,4 @@
+import gc
 import pygame
 import math
 
@@ -5,9 +6,15 @@ from objects_3d import *
 from scene_objects import *
 from lights import *
 from materials import *
+from pipeline import FramePipeline
 
 pygame.init()
 
+# Prepare each camera's next frame on a worker thread while the current one is drawn
+# This overlaps the two, but every frame shows the scene as it was one frame earlier, so input takes a frame longer to show
+# Set to False to prepare and draw each frame in turn, without the extra frame of latency
+USE_PIPELINE = True
+
 if __name__ == "__main__":
     flags = pygame.DOUBLEBUF | pygame.HWSURFACE
     screen = pygame.display.set_mode(SCREEN_SIZE, flags)
@@ -18,6 +25,8 @@ if __name__ == "__main__":
     cams = [Camera([0, 0, 0], [0, 0, 0], screen), Camera([0, 10, 5], [-math.pi/2, -math.pi/2, 0], screen)]
 
     camIndex = False
+    showStats = False
+    splitScreen = False
 
     # Generate a cube of points
     points = []
@@ -57,24 +66,50 @@ if __name__ == "__main__":
     cams[0].setScene(scene)
     cams[1].setScene(scene)
 
+    # Each camera prepares its next frame while the current one is drawn, see USE_PIPELINE
+    pipelines = [FramePipeline(cam) for cam in cams]
+
+    # The scene lasts for the whole session, so keep the garbage collector from scanning it over and over
+    gc.freeze()
+
     clock = pygame.time.Clock()
     while True:
         for event in pygame.event.get():
             if event.type == pygame.KEYDOWN:
                 if event.key == pygame.K_c:
                     camIndex = not camIndex
+                if event.key == pygame.K_p:
+                    showStats = not showStats
+                if event.key == pygame.K_g:
+                    for cam in cams:
+                        cam.setShadingMode(FLAT if cam.shadingMode == SMOOTH_GOURAUD else SMOOTH_GOURAUD)
+                if event.key == pygame.K_t:
+                    for cam in cams:
+                        cam.setRenderMode(SHADED if cam.renderMode == TEXTURED else TEXTURED)
+                if event.key == pygame.K_h:
+                    pLight.setShadows(not pLight.castShadows)
+                if event.key == pygame.K_v:
+                    # Show both cameras side by side
+                    splitScreen = not splitScreen
+                    halfWidth = SCREEN_SIZE[0]//2
+                    for c, cam in enumerate(cams):
+                        cam.setScreen(screen.subsurface((c*halfWidth, 0, halfWidth, SCREEN_SIZE[1])) if splitScreen else screen)
             if event.type == pygame.QUIT:
                 pygame.quit()
                 break
 
         # Clear the screen
         screen.fill((255, 255, 255))
-        # Run pre-render calculations
-        cams[int(camIndex)].preRender()
-        # Render the scene
-        cams[int(camIndex)].renderScene()
-        # Render some debug information about the camera
-        cams[int(camIndex)].renderDebug()
+        # Render the scene, and start the pre-render calculations for the next frame
+        shown = [0, 1] if splitScreen else [int(camIndex)]
+        for c in shown:
+            if USE_PIPELINE:
+                pipelines[c].renderFrame()
+            else:
+                cams[c].preRender()
+                cams[c].renderScene()
+            # Render some debug information about the camera
+            cams[c].renderDebug(showStats)
 
         keys = pygame.key.get_pressed()
         # Handle cam rotation
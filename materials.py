@@ -1,5 +1,6 @@
 from objects_3d import AMBIENT_LIGHT_MULT
 from math_helper import *
+from textures import loadTexture
 
 class Material:
     def __init__(self):
@@ -20,8 +21,21 @@ class Material:
             return
         self.shaders[shaderType] = shader
 
+    def getState(self):
+        '''
+        Get a snapshot of everything that affects the colour of this material
+        '''
+        return tuple((shaderType, shader.getState()) for shaderType, shader in self.shaders.items())
+
     def isColour(self):
-        return not self._diffuse.useImage()
+        return not self.shaders.get('diffuse').useImage()
+
+    def getTexture(self):
+        '''
+        Get the texture of the diffuse shader, or None if it is a plain colour
+        '''
+        diffuse = self.shaders.get('diffuse')
+        return diffuse.texture if diffuse.useImage() else None
 
     def getColour(self, poly, lights):
         polyColour = self.shaders.get('diffuse').colour
@@ -39,26 +53,64 @@ class Material:
 
         return polyColour
 
+    def getColours(self, centres, normals, lights, shadows=None):
+        '''
+        Get the colours of many faces at once from (N, 3) arrays of their global centres and normals
+        Shadows is an optional list with the ShadowMap of each light, or None for lights without one
+        '''
+        polyColour = np.array(self.shaders.get('diffuse').colour, dtype=float)
+        # Start with ambient light
+        lightMult = np.array(AMBIENT_LIGHT_MULT, dtype=float)
+
+        factor = self.shaders.get('diffuse').getLightMults(centres, normals, lights, shadows)
+        colours = polyColour*np.minimum(lightMult+factor, 255)/255
+        # Specular is additive, adds to colour.
+        colours += self.shaders.get('specular').getLightMults(centres, normals, lights, shadows)
+
+        return colours
+
 class NullShader:
+    def getState(self):
+        return ()
+
+    def useImage(self):
+        return False
+
     def getLightMult(self, poly, lights):
         return [0, 0, 0]
 
+    def getLightMults(self, centres, normals, lights, shadows=None):
+        return np.zeros((len(centres), 3))
+
 class DiffuseShader:
     def __init__(self, colour=[0, 0, 0]):
         self.colour = colour
         self.image = None
+        self.texture = None
+
+    def setImage(self, image):
+        '''
+        Set an image file path or pygame Surface to texture faces with, it is tinted by the colour
+        '''
+        self.image = image
+        self.texture = None if image is None else loadTexture(image)
 
     def useImage(self):
-        return bool(self.image)
+        return self.image is not None
+
+    def getState(self):
+        return (tuple(self.colour), id(self.image))
 
     def getLightMult(self, poly, lights):
         lightMult = [0, 0, 0]
 
+        # The geometry is the same for every light
+        centrePos = poly.getGlobalCentrePos()
+        normal = poly.getGlobalNormal()
+
         for light in lights:
-            centrePos = poly.getGlobalCentrePos()
             power = light.calculateFalloff(centrePos)
 
-            normal = poly.getGlobalNormal()
             theta = getAngleNormalToLight(normal, centrePos, light)
 
             diffuse = power*math.sin(theta)
@@ -66,6 +118,29 @@ class DiffuseShader:
 
         return lightMult
 
+    def getLightMults(self, centres, normals, lights, shadows=None):
+        '''
+        Get the diffuse light multipliers of every face against every light at once
+        '''
+        if not lights:
+            return np.zeros((len(centres), 3))
+
+        # (L, N) arrays of each light's power and angle at each face
+        powers = np.array([light.calculateFalloffs(centres) for light in lights])
+        lightPoss = np.array([light.getPositions(centres) for light in lights])
+        thetas = getAnglesNormalToLight(normals, centres, lightPoss)
+        if shadows is not None:
+            powers = powers*np.array([np.ones(len(centres)) if shadow is None else shadow.getVisibility(centres) for shadow in shadows])
+
+        diffuse = powers*np.sin(thetas)
+        return diffuse.T @ np.array([light.colour for light in lights], dtype=float)
+
 class SpecularShader:
+    def getState(self):
+        return ()
+
     def getLightMult(self, poly, lights):
         return [0, 0, 0]
+
+    def getLightMults(self, centres, normals, lights, shadows=None):
+        return np.zeros((len(centres), 3))
@@ -1,4 +1,6 @@
 import math
+import numpy as np
+
 import objects_3d
 # from objects_3d import Vertex, Camera
 
@@ -37,6 +39,13 @@ def normalise(vector):
     except:
         return [0, 0, 0]
 
+def normaliseAll(vectors):
+    '''
+    Normalise an array of vectors along its last axis, zero length vectors are left as zero
+    '''
+    mag = np.sqrt((vectors**2).sum(axis=-1, keepdims=True))
+    return np.divide(vectors, mag, out=np.zeros(np.shape(vectors)), where=mag != 0)
+
 def getAngleNormalToLight(normal, normalPos, light):
     '''
     Get the angle between a given normal vector and a given light's position
@@ -48,7 +57,99 @@ def getAngleNormalToLight(normal, normalPos, light):
 
     return max(math.pi/2-math.acos(sum([lightVec[a]*normalVec[a] for a in range(3)])), 0)
 
+def getAnglesNormalToLight(normals, normalPoss, lightPoss):
+    '''
+    Get the angles between arrays of normal vectors and the positions of lights
+    Arrays are broadcast together, so (L, N, 3) light positions give (L, N) angles
+    '''
+    lightVecs = normaliseAll(normalPoss-lightPoss)
+    normalVecs = normaliseAll(normals)
+
+    dots = np.clip((lightVecs*normalVecs).sum(axis=-1), -1, 1)
+    return np.maximum(math.pi/2-np.arccos(dots), 0)
+
 def getAngleBetween(vector1, vector2):
     vec1 = normalise(vector1)
     vec2 = normalise(vector2)
     return math.acos(sum([vec1[a]*vec2[a] for a in range(3)]))
+
+
+def getRotationMatrix(rot):
+    '''
+    Get the matrix which rotates a camera-relative vector into camera local space
+    Equivalent to the polar angle rotations done in Vertex.getLocalPos
+    '''
+    cosX, sinX = math.cos(rot[0]), math.sin(rot[0])
+    cosY, sinY = math.cos(rot[1]), math.sin(rot[1])
+
+    # Rotate around the y axis first (xtheta), then around the x axis (ytheta)
+    yaw = np.array([[cosX, 0, -sinX],
+                    [0, 1, 0],
+                    [sinX, 0, cosX]])
+    pitch = np.array([[1, 0, 0],
+                      [0, cosY, -sinY],
+                      [0, sinY, cosY]])
+
+    return pitch @ yaw
+
+def getViewMatrix(pos, rot):
+    '''
+    Get the 4x4 matrix which moves world space points into the local space of a camera
+    '''
+    rotation = getRotationMatrix(rot)
+
+    matrix = np.identity(4)
+    matrix[:3, :3] = rotation
+    matrix[:3, 3] = -rotation @ np.array(pos, dtype=float)
+    return matrix
+
+def getProjectionMatrix(screenSize, cameraDepth):
+    '''
+    Get the 4x4 matrix which projects camera local points onto a screen
+    Dividing x and y of the result by w gives the screen position, z is left as the depth
+    '''
+    return np.array([[cameraDepth, 0, screenSize[0]/2, 0],
+                     [0, -cameraDepth, screenSize[1]/2, 0],
+                     [0, 0, 1, 0],
+                     [0, 0, 1, 0]], dtype=float)
+
+def getModelMatrix(pos=(0, 0, 0), rot=(0, 0, 0), scale=1):
+    '''
+    Get the 4x4 matrix which scales, rotates around the x, y then z axes, then moves an object within its parent
+    The scale can be one number or one for each axis
+    '''
+    cosX, sinX = math.cos(rot[0]), math.sin(rot[0])
+    cosY, sinY = math.cos(rot[1]), math.sin(rot[1])
+    cosZ, sinZ = math.cos(rot[2]), math.sin(rot[2])
+
+    rotX = np.array([[1, 0, 0], [0, cosX, -sinX], [0, sinX, cosX]])
+    rotY = np.array([[cosY, 0, sinY], [0, 1, 0], [-sinY, 0, cosY]])
+    rotZ = np.array([[cosZ, -sinZ, 0], [sinZ, cosZ, 0], [0, 0, 1]])
+
+    matrix = np.identity(4)
+    matrix[:3, :3] = rotZ @ rotY @ rotX * np.broadcast_to(np.array(scale, dtype=float), 3)
+    matrix[:3, 3] = pos
+    return matrix
+
+def applyMatrix(matrix, points):
+    '''
+    Move an (N, 3) array of points by a 4x4 affine matrix
+    '''
+    return points @ matrix[:3, :3].T + matrix[:3, 3]
+
+def applyMatrices(matrices, points):
+    '''
+    Move an (N, 3) array of points by each of an (M, 4, 4) stack of affine matrices, giving (M, N, 3) points
+    '''
+    return points @ matrices[:, :3, :3].transpose(0, 2, 1) + matrices[:, None, :3, 3]
+
+def getNormalMatrix(matrix):
+    '''
+    Get the matrix which moves normals, as rows, along with points moved by a 4x4 matrix or an (N, 4, 4) stack of them
+    Normals are crossed edges, which move by the cofactors of the matrix
+    Its sign is kept positive, so a mirroring matrix doesn't turn faces inside out
+    '''
+    linear = np.asarray(matrix, dtype=float)[..., :3, :3]
+    a, b, c = linear[..., 0], linear[..., 1], linear[..., 2]
+    adjugate = np.stack([np.cross(b, c), np.cross(c, a), np.cross(a, b)], axis=-2)
+    return adjugate*np.sign(np.linalg.det(linear))[..., None, None]
@@ -1,10 +1,12 @@
 import pygame
+import numpy as np
 
 import math
-from time import time
-from copy import deepcopy
+from array import array
+from time import time, perf_counter
 
 from math_helper import *
+from clipping import *
 
 #Initialise the constants
 SCREEN_SIZE = (1200, 675)
@@ -26,6 +28,9 @@ NO_OUTLINE = 4
 
 POLY_OUTLINE = NO_OUTLINE
 
+# Whether wireframes include the edges inside a polygon, made when it was split into triangles
+SHOW_DIAGONALS = False
+
 WIREFRAME = 5
 WIREFRAME_DOTS = 6
 SHADED = 7
@@ -33,9 +38,69 @@ TEXTURED = 8
 
 RENDER_MODE = SHADED
 
+PAINTERS = 9
+Z_BUFFER = 10
+
+RASTER_MODE = PAINTERS
+
 AMBIENT_LIGHT_MULT = [31, 31, 31]
 
+# Clip faces against the sides of the screen as well as the near and far planes
+CLIP_SIDES = True
+
+def asArray(values, kind, dtype):
+    '''
+    Make values into an array, keeping their own dtype if it is already of the given kind so arrays like memory maps aren't copied
+    Values of any other kind are converted to dtype
+    '''
+    values = np.asarray(values)
+    return values if np.issubdtype(values.dtype, kind) else values.astype(dtype)
+
+def chainEdges(edges, order):
+    '''
+    Join (E, 2) edges end to end into strips, taking the edges in the given order
+    Returns the vertices along every strip one after another, and the index in them of the first vertex of each edge
+    '''
+    # The edges at each vertex, used ones are dropped as they are reached
+    around = {}
+    for e in order:
+        a, b = edges[e].tolist()
+        around.setdefault(a, []).append(e)
+        around.setdefault(b, []).append(e)
+
+    used = np.zeros(len(edges), dtype=bool)
+    strips = array('q')
+    edgeStarts = np.zeros(len(edges), dtype=int)
+    for e in order:
+        if used[e]:
+            continue
+        vertex = int(edges[e, 0])
+        strips.append(vertex)
+        while e is not None:
+            used[e] = True
+            edgeStarts[e] = len(strips)-1
+            a, b = edges[e].tolist()
+            vertex = b if vertex == a else a
+            strips.append(vertex)
+
+            # Carry on along any unused edge from the end of the strip
+            edgesHere = around[vertex]
+            while edgesHere and used[edgesHere[-1]]:
+                edgesHere.pop()
+            e = edgesHere[-1] if edgesHere else None
+
+    return np.frombuffer(strips, dtype=np.int64).astype(int), edgeStarts
+
 class Primitive:
+    # Slots keep millions of small faces and vertices compact, they can still be weakly referenced by cameras
+    __slots__ = ('__weakref__',)
+
+    def getDepth(self, cam):
+        '''
+        Get the depth of the centre of the primitive from the given camera
+        '''
+        return self.getCentrePos()[2]
+
     def __lt__(self, other):
         if isinstance(other, Primitive):
             return self.getCentrePos()[2] < other.getCentrePos()[2]
@@ -71,6 +136,8 @@ class Primitive:
         return avgPos
 
 class NGon(Primitive):
+    __slots__ = ('vertices', 'tris')
+
     def __init__(self, vertices, material, flipped=False, backCull=True):
         # Check the number of vertices
         if len(vertices) < 3:
@@ -91,21 +158,9 @@ class NGon(Primitive):
             a = (n-2)//2
             self.tris.append(Triangle([vertices[b] for b in [a, -a-1, -a-2]], material, flipped, backCull))
 
-    def preRender(self, cam):
-        '''
-        Calculate all of the pre-render information
-        '''
-        for t in range(len(self.tris)):
-            self.tris[t].preRender(cam)
-
-    def render(self, cam):
-        '''
-        Render this shape to the screen
-        '''
-        for tri in self.tris:
-            tri.render(cam)
-
 class Quad(NGon):
+    __slots__ = ()
+
     def __init__(self, vertices, material, flipped=False, backCull=True):
         if len(vertices) > 4:
             raise OverflowError('Too many vertices for a quad.')
@@ -114,173 +169,45 @@ class Quad(NGon):
         super().__init__(vertices, material, flipped, backCull)
 
 class Line(Primitive):
+    __slots__ = ('vertices',)
+
     def __init__(self, vertices):
         self.vertices = vertices
 
-    def preRender(self, cam):
-        for v in range(len(self.vertices)):
-            self.vertices[v].preRender(cam)
-
-    def render(self, cam):
-        for vertex in self.vertices:
-            vertex.render(cam)
-
-        pygame.draw.lines(cam.screen, (0, 0, 0), True, [v.screenPos for v in self.vertices], 3)
-
-class Triangle(Primitive):
-    def __init__(self, vertices, material, flipped=False, backCull=True):
-        self.vertices = deepcopy(vertices)
-
-        self.material = material
-        self.frameColour = [255, 255, 255]
-        self.shouldRender = True
-
-        self.flipNormal = flipped
-        self.shouldCull = backCull
-
-    def preRender(self, cam):
-        '''
-        Calculate all of the pre-render information
-        '''
-        for v in range(len(self.vertices)):
-            self.vertices[v].preRender(cam)
-
-        # Check if any point is behind z=0
-        lessZ = [a.localPos[2] < 0 for a in self.vertices]
-        if any(lessZ) and not all(lessZ):
-            # Scale it to z=NEAR_CLIP
-            less = [v for v, vert in enumerate(self.vertices) if lessZ[v]]
-            great = [v for v in range(3) if v not in less]
-            for lIn in less:
-                lPos = self.vertices[lIn].localPos
-                lPosses = []
-                for gIn in great:
-                    gPos = self.vertices[gIn].localPos
-                    # Calculate the vector between the two points
-                    vector = [gPos[a] - lPos[a] for a in range(3)]
-                    # Calculate the scale ratio
-                    zRatio = abs((gPos[2]-NEAR_CLIP*1.5)/vector[2])
-                    # Scale the vector
-                    vector = [a*zRatio for a in vector]
-                    # Calculate and set the position
-                    pos = [gPos[a]-vector[a] for a in range(3)]
-
-                    lPosses.append([pos, None])
-
-                    # Get the offscreen point's position and the onscreen point's position for scaling
-                    screenPos = list(Vertex.projectPoint(pos))
-                    onscreenPos = Vertex.projectPoint(self.vertices[gIn].localPos)
-
-                    # Determine the correct ratio to use
-                    ratio = 1
-                    testX = screenPos[0] != onscreenPos[0]
-                    testY = screenPos[1] != onscreenPos[1]
-
-                    if testX and screenPos[0] > SCREEN_SIZE[0]:
-                        ratio = (SCREEN_SIZE[0]-onscreenPos[0])/(screenPos[0]-onscreenPos[0])
-                    elif testX and screenPos[0] < 0:
-                        ratio = onscreenPos[0]/(screenPos[0]-onscreenPos[0])
-                    elif testY and screenPos[1] > SCREEN_SIZE[1]:
-                        ratio = (SCREEN_SIZE[1]-onscreenPos[1])/(screenPos[1]-onscreenPos[1])
-                    elif testY and screenPos[1] < 0:
-                        ratio = onscreenPos[1]/(screenPos[1]-onscreenPos[1])
-
-                    ratio = abs(ratio)
-
-                    # Scale the screen position if the position is actually offscreen, otherwise, just leave it
-                    # if not (0 < screenPos[a] < SCREEN_SIZE[a]) else screenPos[a]
-                    screenPos = [int((screenPos[a]-onscreenPos[a])*ratio+onscreenPos[a]) for a in (0, 1)]
-                    lPosses[-1][-1] = screenPos
-
-                if len(lPosses) == 2:
-                    # Construct the quad as required using lPosses
-                    vPos = [lPosses[0], lPosses[1], [self.vertices[great[1]].localPos, self.vertices[great[1]].screenPos]]
-                    vertices = [Vertex([0, 0, 0]) for a in vPos]
-
-                    # Set the screen positions for the vertices
-                    for v in range(len(vertices)):
-                        vertices[v].screenScale = 1
-                        # Project the 3D point to the 2D screen
-                        vertices[v].screenPos = vPos[v][1]
-                        vertices[v].localPos = vPos[v][0]
-
-                    # Duplicate this triangle, but replace the vertices
-                    t = Triangle.fromExisting(self, vertices)
-                    cam.addFrameFace(t)
-
-                # Set the screenPos
-                self.vertices[lIn].localPos, self.vertices[lIn].screenPos = lPosses[0]
-
-        self.shouldRender = self.backFaceCull()
-        if not self.shouldRender:
-            return
-
-        self.frameColour = self.material.getColour(self, cam.scene.getLights())
-
-    def render(self, cam):
+    def preRender(self, cam, matrix=None):
         '''
-        Render this triangle to the given camera's screen
+        Project the points of the line, moved by its object's world matrix if given
+        The results are kept by the camera
         '''
-        if not self.shouldRender:
-            return
-
-        # Get the colour to render the triangle with
-        screenPoints = [vertex.screenPos for vertex in self.vertices]
-
-        if RENDER_MODE == SHADED:
-            # Render according to SHADING_MODE value
-            try:
-                if SHADING_MODE == FLAT:
-                    pygame.draw.polygon(cam.screen, self.frameColour, screenPoints)
-                elif SHADING_MODE == SMOOTH_GOURAUD:
-                    pass
-                elif SHADING_MODE == SMOOTH_PHONG:
-                    pass
-            except TypeError:
-                pass
+        points = np.array([v.pos for v in self.vertices], dtype=float).reshape(-1, 3)
+        if matrix is not None:
+            points = applyMatrix(matrix, points)
+        cam.primitiveFrames[self] = Vertex.transformPoints(points, cam)
 
-        elif RENDER_MODE == TEXTURED:
-            try:
-                if self.material.isColour():
-                    # No image and UVs set for this poly.
-                    pygame.draw.polygon(cam.screen, self.frameColour, screenPoints)
-                else:
-                    # Render with a texture
-                    pass
-            except TypeError:
-                pass
-
-        # render hard edges on the polygon if option set
-        if POLY_OUTLINE == HARD_OUTLINE or RENDER_MODE in [WIREFRAME, WIREFRAME_DOTS]:
-            if RENDER_MODE == WIREFRAME_DOTS:
-                [vertex.render(cam) for vertex in self.vertices]
-
-            try:
-                pygame.draw.lines(cam.screen, (0, 0, 0), True, screenPoints, 3)
-            except TypeError:
-                pass
-
-    def backFaceCull(self):
+    def getDepth(self, cam):
         '''
-        Return whether or not this triangle has successfully escaped backface culling
+        Get the depth of the centre of the line from the given camera
         '''
-        if not self.shouldCull:
-            return True
+        return float(cam.primitiveFrames[self][0][:, 2].mean())
 
-        normal = self.getNormal()
-        xthetaNormal = math.atan2(normal[0], normal[2])
+    def render(self, cam):
+        localPos, dist, screenPos, screenScale, shouldRender = cam.primitiveFrames[self]
+        for v in np.flatnonzero(shouldRender):
+            pygame.draw.circle(cam.screen, (0, 0, 0), screenPos[v].tolist(), int(screenScale[v]))
 
-        # Get the centre position of the face
-        avgPos = self.getCentrePos()
+        pygame.draw.lines(cam.screen, (0, 0, 0), True, screenPos.tolist(), 3)
 
-        xthetaCam = math.atan2(avgPos[0], avgPos[2])
+class Triangle(Primitive):
+    __slots__ = ('vertices', 'material', 'flipNormal', 'shouldCull')
 
-        diff = abs(xthetaCam-xthetaNormal)
+    def __init__(self, vertices, material, flipped=False, backCull=True):
+        # Vertices are shared with the other faces that use them, the mesh holds all per-frame data
+        self.vertices = tuple(vertices)
 
-        if diff > 0.52*math.pi:
-            return False
+        self.material = material
 
-        return True
+        self.flipNormal = flipped
+        self.shouldCull = backCull
 
     def getGlobalNormal(self):
         '''
@@ -296,36 +223,84 @@ class Triangle(Primitive):
             normal = [-a for a in normal]
         return normal
 
-    def getNormal(self):
+    def preRender(self, cam):
         '''
-        Get the normal vector of the triangle in cam/local 3D space
+        Project and light a triangle which isn't part of a mesh, like the faces added for a single frame
+        The results are kept by the camera
         '''
-        # Create the two vectors
-        U = [self.vertices[1].localPos[a]-self.vertices[0].localPos[a] for a in range(3)]
-        V = [self.vertices[2].localPos[a]-self.vertices[0].localPos[a] for a in range(3)]
+        points = np.array([v.pos for v in self.vertices], dtype=float)
+        localPos, dist, screenPos, screenScale, shouldRender = Vertex.transformPoints(points, cam)
 
-        # Take the cross product
-        normal = [U[(a+1)%3]*V[(a+2)%3] - U[(a+2)%3]*V[(a+1)%3] for a in range(3)]
-        if self.flipNormal:
-            normal = [-a for a in normal]
-        return normal
+        centre = points.mean(axis=0)
+        normal = np.array(self.getGlobalNormal(), dtype=float)
+        # Faces crossing the near plane aren't clipped, so they are skipped
+        visible = (localPos[:, 2] > NEAR_CLIP).all() and (not self.shouldCull or normal @ (centre-cam.pos) >= 0)
+
+        colour = self.material.getColours(centre[None], normal[None], cam.scene.getLights(), cam.scene.getShadowMaps())[0]
+        cam.primitiveFrames[self] = (localPos, screenPos, colour, visible)
+
+    def getDepth(self, cam):
+        return float(cam.primitiveFrames[self][0][:, 2].mean())
+
+    def render(self, cam):
+        localPos, screenPos, colour, visible = cam.primitiveFrames[self]
+        if visible:
+            pygame.draw.polygon(cam.screen, colour.tolist(), screenPos.tolist())
+
+class PooledTriangle(Triangle):
+    '''
+    A triangle with its own vertices, which goes back to its pool once the frame it was used in is prepared
+    '''
+    __slots__ = ('pool',)
+
+    def __init__(self, pool):
+        super().__init__([Vertex(0, 0, 0) for a in range(3)], None)
+        self.pool = pool
+
+class TrianglePool:
+    '''
+    Triangles which are reused from frame to frame, for faces which only last one frame
+    Reusing them means a long session doesn't keep making and collecting new faces
+    '''
+    def __init__(self):
+        self.free = []
+
+    def get(self, positions, material, flipped=False, backCull=True):
+        '''
+        Get a triangle with its corners at three positions
+        '''
+        tri = self.free.pop() if self.free else PooledTriangle(self)
+        for vertex, pos in zip(tri.vertices, positions):
+            vertex.pos[:] = pos
+        tri.material = material
+        tri.flipNormal = flipped
+        tri.shouldCull = backCull
+        return tri
 
     @staticmethod
-    def fromExisting(triangle, vertices):
-        t = Triangle(vertices, triangle.material)
-        t.frameColour = triangle.frameColour
-        t.shouldCull = triangle.shouldCull
-        return t
+    def release(faces):
+        '''
+        Put every pooled triangle in a list of faces back into the pool it came from
+        '''
+        for face in faces:
+            if isinstance(face, PooledTriangle):
+                face.pool.free.append(face)
 
 class Vertex:
-    def __init__(self, x, y=0, z=0):
+    __slots__ = ('pos', 'uv', 'localPos', 'screenPos', 'screenScale', 'shouldRender')
+
+    def __init__(self, x, y=0, z=0, uv=None):
         if isinstance(x, list):
             self.pos = x
         else:
             self.pos = [x, y, z]
 
-        self.localPos = list(self.pos)
-        self.screenPos = [0, 0]
+        # Texture coordinates, from 0 to 1 across the texture
+        self.uv = uv
+
+        # Replaced rather than changed by preRender, so the position can be shared until then
+        self.localPos = self.pos
+        self.screenPos = (0, 0)
         self.screenScale = 0
         self.shouldRender = True
 
@@ -384,6 +359,50 @@ class Vertex:
 
         return (int(x), int(y))
 
+    @staticmethod
+    def projectPoints(localPos, projection=None):
+        '''
+        Project an (N, 3) array of 3D points to the 2D space of a screen with a camera's projection matrix
+        '''
+        if projection is None:
+            projection = getProjectionMatrix(SCREEN_SIZE, CAMERA_DEPTH)
+
+        w = localPos @ projection[3, :3] + projection[3, 3]
+        behind = w == 0
+        # Avoid the division by zero, the points get moved offscreen afterwards
+        w = np.where(behind, 1, w)
+
+        # Offset from the centre of the screen after scaling, so points on the centre lines land exactly on them
+        screenPos = np.empty((len(localPos), 2), dtype=int)
+        screenPos[:, 0] = np.trunc(projection[0, 2]+localPos[:, 0]*(projection[0, 0]/w))
+        screenPos[:, 1] = np.trunc(projection[1, 2]+localPos[:, 1]*(projection[1, 1]/w))
+        screenPos[behind] = -50
+
+        return screenPos
+
+    @staticmethod
+    def transformPoints(points, cam):
+        '''
+        Run the pre-render calculations for an (N, 3) array of points in one go
+        Returns the local positions, distances, screen positions, screen scales and render flags
+        '''
+        screenSize = cam.getScreenSize()
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        localPos = applyMatrix(cam.getViewMatrix(), points)
+        dist = np.sqrt(((points-cam.pos)**2).sum(axis=1))
+
+        # Calculate the scale of the points
+        screenScale = np.where(dist < FAR_CLIP, (1-(dist/FAR_CLIP))*10, 0).astype(int)
+
+        # Project the 3D points to the 2D screen
+        screenPos = Vertex.projectPoints(localPos, cam.getProjectionMatrix())
+
+        shouldRender = ((localPos[:, 2] > 0) & (NEAR_CLIP <= dist) & (dist <= FAR_CLIP) &
+                        (0 < screenPos[:, 0]) & (screenPos[:, 0] < screenSize[0]) &
+                        (0 < screenPos[:, 1]) & (screenPos[:, 1] < screenSize[1]))
+
+        return localPos, dist, screenPos, screenScale, shouldRender
+
     def getDistance(self, cam):
         '''
         Get the distance of this point from the given camera
@@ -396,26 +415,936 @@ class Vertex:
         '''
         Get a position for the point with respect to the camera
         '''
-        # Translate the position
-        point = [self.pos[a]-camera.pos[a] for a in range(3)]
+        self.localPos = applyMatrix(camera.getViewMatrix(), np.array(self.pos, dtype=float)).tolist()
+
+        return self.localPos
+
+class Mesh:
+    '''
+    An indexed triangle mesh
+    All faces index into one shared vertex buffer, so each vertex is only transformed once per frame
+    '''
+    def __init__(self):
+        self.vertices = []
+        self.triangles = []
+        self.materials = []
+
+        # Vertex positions in the object's own space, and moved into world space by the object's matrix
+        self.localPositions = np.zeros((0, 3))
+        self.positions = np.zeros((0, 3))
+        self.matrix = np.identity(4)
+        # Face centres and normals and vertex normals in the object's own space
+        self.localCentres = np.zeros((0, 3))
+        self.localNormals = np.zeros((0, 3))
+        self.localVertexNormals = np.zeros((0, 3))
+        self.faces = np.zeros((0, 3), dtype=int)
+        self.flipped = np.zeros(0, dtype=bool)
+        self.backCull = np.zeros(0, dtype=bool)
+        self.faceMaterials = np.zeros(0, dtype=int)
+        # The polygon each face was split from, edges between faces of the same polygon are diagonals
+        self.facePolygons = np.zeros(0, dtype=int)
+
+        # World space geometry of the faces, used for lighting
+        self.globalCentres = np.zeros((0, 3))
+        self.globalNormals = np.zeros((0, 3))
+        # Normals of the vertices, used for smooth shading
+        self.vertexNormals = np.zeros((0, 3))
+        # Texture coordinates of the vertices
+        self.uvs = np.zeros((0, 2))
+
+        self._vertexIndex = {}
+        # The vertex indices of every face, flat and unboxed until the mesh is built
+        self._faceList = array('q')
+        self._polygonList = array('q')
+        self._polygonCount = 0
+        self._dirty = False
+        # Whether the mesh was built with setArrays rather than from polygons
+        self._fromArrays = False
+        self.version = 0
+
+        # Lit colours are cached until the geometry, a material or a light changes
+        self._lit = np.zeros(0, dtype=bool)
+        self._lightingKey = None
+        # The unique edges of the faces, only worked out again when the faces change
+        self._edges = None
+        # The version of the mesh the hard edges were found for, and the edges
+        self._hardEdges = (None, np.zeros((0, 2), dtype=int))
+
+        # Lit colour of every face, shared by every camera
+        self.faceColours = np.zeros((0, 3))
+        # Lit colour of every vertex with each material, for smooth shading
+        self.vertexColours = np.zeros((0, 0, 3))
+        self._vertexLit = np.zeros((0, 0), dtype=bool)
+
+    def addPolygon(self, poly):
+        '''
+        Add the triangles of a Triangle or N-Gon to the mesh
+        '''
+        if self._fromArrays:
+            raise ValueError('Polygons can\'t be added to a mesh built from arrays.')
+
+        tris = poly.tris if isinstance(poly, NGon) else [poly]
+        for tri in tris:
+            self._faceList.extend([self._getIndex(vertex) for vertex in tri.vertices])
+            self.triangles.append(tri)
+        self._polygonList.extend([self._polygonCount]*len(tris))
+        self._polygonCount += 1
+
+        self._dirty = True
+
+    def setArrays(self, positions, faces, materials, faceMaterials=None, uvs=None, flipped=None, backCull=None, polygons=None):
+        '''
+        Build the mesh straight from (V, 3) vertex positions and (F, 3) vertex indices, without any Vertex or Triangle objects
+        Each face uses materials[faceMaterials[f]], or the first material if faceMaterials isn't given
+        Faces split from the same polygon share an index in polygons, otherwise each face is its own polygon
+        The positions are in the object's own space, they can be changed in place in localPositions as long as update is called after
+        Arrays which are already floats or integers are used as they are, without copying
+        '''
+        if self.vertices:
+            raise ValueError('A mesh built from polygons can\'t be replaced with arrays.')
+        self._fromArrays = True
+
+        self.localPositions = asArray(positions, np.floating, float).reshape(-1, 3)
+        self.faces = asArray(faces, np.integer, int).reshape(-1, 3)
+        self.materials = list(materials)
+        self.faceMaterials = np.zeros(len(self.faces), dtype=int) if faceMaterials is None else asArray(faceMaterials, np.integer, int)
+        self.uvs = np.zeros((len(self.localPositions), 2)) if uvs is None else asArray(uvs, np.floating, float).reshape(-1, 2)
+        self.flipped = np.zeros(len(self.faces), dtype=bool) if flipped is None else np.asarray(flipped, dtype=bool)
+        self.backCull = np.ones(len(self.faces), dtype=bool) if backCull is None else np.asarray(backCull, dtype=bool)
+        self.facePolygons = np.arange(len(self.faces)) if polygons is None else asArray(polygons, np.integer, int)
+
+        self._build()
+
+    def compact(self):
+        '''
+        Keep only the mesh's arrays, dropping the Vertex and Triangle objects it was built from to save memory
+        Afterwards vertices are moved by changing the localPositions array in place and calling update
+        '''
+        if self._dirty:
+            self.update()
+
+        self._fromArrays = True
+        self.vertices = []
+        self.triangles = []
+        self._vertexIndex = {}
+        self._faceList = array('q')
+        self._polygonList = array('q')
+
+    def _getIndex(self, vertex):
+        '''
+        Get the index of a vertex in the vertex buffer, adding it if it is new
+        '''
+        index = self._vertexIndex.get(id(vertex))
+        if index is None:
+            index = len(self.vertices)
+            self._vertexIndex[id(vertex)] = index
+            self.vertices.append(vertex)
+        return index
+
+    def update(self):
+        '''
+        Rebuild the vertex and index arrays
+        Must be called if the position of a vertex in this mesh is changed
+        '''
+        if not self._fromArrays:
+            self.localPositions = np.array([vertex.pos for vertex in self.vertices], dtype=float).reshape(-1, 3)
+            self.faces = np.frombuffer(self._faceList, dtype=np.int64).reshape(-1, 3).astype(int)
+            self.facePolygons = np.frombuffer(self._polygonList, dtype=np.int64).astype(int)
+            self.flipped = np.array([tri.flipNormal for tri in self.triangles], dtype=bool)
+            self.backCull = np.array([tri.shouldCull for tri in self.triangles], dtype=bool)
+
+            materialIndex = {}
+            for tri in self.triangles:
+                materialIndex.setdefault(id(tri.material), len(materialIndex))
+            self.materials = list({id(tri.material): tri.material for tri in self.triangles}.values())
+            self.faceMaterials = np.array([materialIndex[id(tri.material)] for tri in self.triangles], dtype=int)
+
+            self.uvs = np.array([vertex.uv or (0, 0) for vertex in self.vertices], dtype=float).reshape(-1, 2)
+
+        self._build()
+
+    def setMatrix(self, matrix):
+        '''
+        Set the 4x4 matrix which moves the mesh from its object's space into world space
+        Only the world space arrays are rebuilt, the vertices and the geometry worked out from them are left alone
+        '''
+        self.matrix = np.array(matrix, dtype=float)
+        if not self._dirty:
+            self._place()
+
+    def _build(self):
+        '''
+        Rebuild everything worked out from the vertex and index arrays, in the object's own space
+        '''
+        corners = self.localPositions[self.faces]
+        self.localCentres = corners.mean(axis=1)
+        self.localNormals = np.cross(corners[:, 1]-corners[:, 0], corners[:, 2]-corners[:, 0])
+        self.localNormals[self.flipped] *= -1
+
+        # Each vertex normal is the sum of the normals around it, so larger faces count for more
+        cornerVertices = self.faces.ravel()
+        self.localVertexNormals = np.stack([np.bincount(cornerVertices, np.repeat(self.localNormals[:, a], 3), len(self.localPositions)) for a in range(3)], axis=1)
+
+        self._place()
+
+    def _place(self):
+        '''
+        Move the geometry into world space with the mesh's matrix
+        '''
+        if np.array_equal(self.matrix, np.identity(4)):
+            # Unmoved meshes share their arrays, so a memory mapped mesh isn't copied
+            self.positions = self.localPositions
+            self.globalCentres = self.localCentres
+            self.globalNormals = self.localNormals
+            self.vertexNormals = self.localVertexNormals
+        else:
+            self.positions = applyMatrix(self.matrix, self.localPositions)
+            self.globalCentres = applyMatrix(self.matrix, self.localCentres)
+
+            normalMatrix = getNormalMatrix(self.matrix)
+            self.globalNormals = self.localNormals @ normalMatrix
+            self.vertexNormals = self.localVertexNormals @ normalMatrix
+
+        self.faceColours = np.zeros((len(self.faces), 3))
+        self._lit = np.zeros(len(self.faces), dtype=bool)
+        self.vertexColours = np.zeros((len(self.materials), len(self.positions), 3))
+        self._vertexLit = np.zeros((len(self.materials), len(self.positions)), dtype=bool)
+
+        self._dirty = False
+        self.version += 1
+
+    def getEdges(self):
+        '''
+        Get the unique edges of the faces, chained into strips so runs of them can be drawn as one line
+        Returns the (S,) vertices along every strip one after another, the index in it of the first vertex of each (E,) edge,
+        the edge of each corner of each face, and whether each edge is a diagonal
+        Corner c of face f is the edge from vertex c to vertex c+1, at row 3*f+c
+        A diagonal is only shared by faces split from the same polygon
+        '''
+        if self._dirty:
+            self.update()
+        # Moving vertices doesn't change the edges, only changing the faces does
+        if self._edges is not None and not (self._edges[0] is self.faces and self._edges[1] is self.facePolygons):
+            if np.array_equal(self._edges[0], self.faces) and np.array_equal(self._edges[1], self.facePolygons):
+                self._edges = (self.faces, self.facePolygons)+self._edges[2:]
+            else:
+                self._edges = None
+        if self._edges is None:
+            corners = np.sort(self.faces[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2), axis=1)
+            keys = corners[:, 0]*len(self.positions)+corners[:, 1]
+            unique, first, cornerEdges, counts = np.unique(keys, return_index=True, return_inverse=True, return_counts=True)
+            cornerEdges = cornerEdges.ravel()
+            edges = corners[first]
+
+            # Compare the lowest and highest polygon using each edge
+            order = np.argsort(cornerEdges, kind='stable')
+            polygons = np.repeat(self.facePolygons, 3)[order]
+            starts = np.cumsum(counts)-counts
+            diagonal = np.zeros(len(unique), dtype=bool)
+            if len(unique):
+                diagonal = (counts > 1) & (np.minimum.reduceat(polygons, starts) == np.maximum.reduceat(polygons, starts))
+
+            # Chain the outlines and the diagonals separately, so hiding the diagonals doesn't break up the outlines
+            outlines, diagonals = np.flatnonzero(~diagonal), np.flatnonzero(diagonal)
+            stripVertices, edgeStarts = chainEdges(edges, outlines)
+            diagonalVertices, diagonalStarts = chainEdges(edges, diagonals)
+            edgeStarts[diagonals] = diagonalStarts[diagonals]+len(stripVertices)
+            stripVertices = np.concatenate([stripVertices, diagonalVertices])
+            self._edges = (self.faces, self.facePolygons, stripVertices, edgeStarts, cornerEdges, diagonal)
+        return self._edges[2:]
+
+    def getHardEdges(self):
+        '''
+        Get the (H, 2) vertex indices of the edges on the mesh's boundary, or between faces which aren't in the same plane
+        Across any other edge the mesh is one flat surface
+        '''
+        if self._dirty:
+            self.update()
+        if self._hardEdges[0] != self.version:
+            stripVertices, edgeStarts, cornerEdges, diagonal = self.getEdges()
+
+            # An edge is bent if any face around it isn't parallel to the first face around it
+            lengths = np.linalg.norm(self.localNormals, axis=1, keepdims=True)
+            normals = np.repeat(np.divide(self.localNormals, lengths, out=np.zeros_like(self.localNormals), where=lengths > 0), 3, axis=0)
+            first = np.zeros(len(edgeStarts), dtype=int)
+            found, firstCorner = np.unique(cornerEdges, return_index=True)
+            first[found] = firstCorner
+            bent = np.zeros(len(edgeStarts), dtype=bool)
+            bent[cornerEdges[np.abs((normals*normals[first[cornerEdges]]).sum(axis=1)) < 1-1e-9]] = True
+
+            hard = bent | (np.bincount(cornerEdges, minlength=len(edgeStarts)) == 1)
+            self._hardEdges = (self.version, np.stack([stripVertices[edgeStarts[hard]], stripVertices[edgeStarts[hard]+1]], axis=1))
+        return self._hardEdges[1]
+
+    def getVersion(self):
+        '''
+        Get a number which changes every time the mesh is rebuilt, building it first if needed
+        '''
+        if self._dirty:
+            self.update()
+        return self.version
+
+    def getBoundingPoints(self):
+        '''
+        Get world space points which the mesh's bounding volumes have to contain
+        '''
+        if self._dirty:
+            self.update()
+        return self.positions
+
+    def getWorldTriangles(self):
+        '''
+        Get the (F, 3, 3) world space corners of every face, for shadows and occluders
+        '''
+        if self._dirty:
+            self.update()
+        return self.positions[self.faces]
+
+    def getWorldHardEdges(self):
+        '''
+        Get the (H, 2, 3) world space ends of every hard edge, see getHardEdges
+        '''
+        return self.positions[self.getHardEdges()]
+
+    def getFaceCount(self):
+        '''
+        Get the number of faces drawn by prepareFrame
+        '''
+        return len(self.faces)
+
+    def getVertexCount(self):
+        '''
+        Get the number of vertices drawn by prepareFrame
+        '''
+        return len(self.positions)
+
+    def getFaceVertices(self, faces):
+        '''
+        Get the (N, 3) vertex indices of the given faces
+        '''
+        return self.faces[faces]
+
+    def getPositions(self, vertices):
+        '''
+        Get the world space positions of the given vertices
+        '''
+        return self.positions[vertices]
+
+    def getUVs(self, vertices):
+        '''
+        Get the texture coordinates of the given vertices, in any shape
+        '''
+        return self.uvs[vertices]
+
+    def getFaceMaterials(self, faces):
+        '''
+        Get the index into materials of each of the given faces
+        '''
+        return self.faceMaterials[faces]
+
+    def preRender(self, cam):
+        '''
+        Calculate all of the pre-render information for every face in the mesh
+        The results are stored in the camera's MeshFrame for this mesh
+        '''
+        if self._dirty:
+            self.update()
+        self.prepareFrame(cam, cam.getMeshFrame(self))
+
+    def prepareFrame(self, cam, view):
+        '''
+        Fill a MeshFrame with everything needed to draw this mesh's faces this frame
+        '''
+        view.update(self)
+        # The frame may be drawn after the mesh has changed, so it keeps the edges it was prepared with
+        view.edges = self.getEdges() if cam.renderMode in (WIREFRAME, WIREFRAME_DOTS) else None
+
+        start = perf_counter()
+
+        # Cull the faces pointing away from the camera before doing any other work on them
+        faces = np.flatnonzero(self.backFaceCull(cam))
+        start = cam.timeStage('cull', start)
+        cam.count('culledFaces', self.getFaceCount()-len(faces))
+
+        # Transform and project each vertex of the remaining faces once
+        faceVertices = self.getFaceVertices(faces)
+        vertexCount = self.getVertexCount()
+        used = np.zeros(vertexCount, dtype=bool)
+        used[faceVertices] = True
+        used = np.flatnonzero(used)
+
+        view.localPos = np.zeros((vertexCount, 3))
+        view.screenPos = np.zeros((vertexCount, 2), dtype=int)
+        view.screenScale = np.zeros(vertexCount, dtype=int)
+        view.shouldRender = np.zeros(vertexCount, dtype=bool)
+        (view.localPos[used], dist, view.screenPos[used],
+         view.screenScale[used], view.shouldRender[used]) = Vertex.transformPoints(self.getPositions(used), cam)
+
+        local = view.localPos[faceVertices]
+        start = cam.timeStage('transform', start)
+        cam.count('vertices', len(used))
+
+        # Drop the faces completely outside a clipping plane, and clip the ones crossing them
+        if CLIP_SIDES:
+            planes = getClipPlanes(NEAR_CLIP, FAR_CLIP, cam.getScreenSize(), CAMERA_DEPTH)
+        else:
+            planes = getClipPlanes(NEAR_CLIP, FAR_CLIP)
+        rejected, crossing = classifyFaces(local, planes)
+        faces, faceVertices, local, crossing = faces[~rejected], faceVertices[~rejected], local[~rejected], crossing[~rejected]
+        clipped = np.flatnonzero(crossing)
+
+        # Anything blended across the faces is clipped along with the positions
+        channels = [local]
+        smooth = cam.isSmooth()
+        if smooth:
+            # Light the vertices before clipping, so the colours can be clipped too
+            start = cam.timeStage('clip', start)
+            corners = self.shadeVertices(cam, faces)
+            start = cam.timeStage('shade', start)
+            channels.append(corners)
+        textured = cam.renderMode == TEXTURED and not all(material.isColour() for material in self.materials)
+        if textured:
+            uvs = self.getUVs(faceVertices)
+            channels.append(uvs)
+
+        points = np.concatenate(channels, axis=2) if len(channels) > 1 else local
+        polys, counts = clipPolygons(points[clipped], planes)
+        tris, owner, fanIndex = triangulateFans(polys, counts)
+
+        keep = np.ones(len(faces), dtype=bool)
+        keep[clipped[counts < 3]] = False
+        cam.count('rejectedFaces', int(np.count_nonzero(rejected)+np.count_nonzero(counts < 3)))
+        cam.count('clippedFaces', len(clipped))
+        visibleFaces = faces[keep]
+
+        view.faceVisible = np.zeros(self.getFaceCount(), dtype=bool)
+        view.faceVisible[visibleFaces] = True
+        # The vertices of each visible face, for drawing dots
+        view.faceVertices = faceVertices[keep]
+        start = cam.timeStage('clip', start)
+
+        if not smooth:
+            colours = self.shadeFaces(cam, visibleFaces)
+            start = cam.timeStage('shade', start)
+
+        # The first triangle of each visible face gets the face's row, the rest of the fans come after
+        rowCount = len(visibleFaces)
+        view.faceRows = np.full(self.getFaceCount(), -1)
+        view.faceRows[visibleFaces] = np.arange(rowCount)
+
+        first = fanIndex == 0
+        clippedRows = view.faceRows[faces[clipped[owner[first]]]]
+        extraFaces = faces[clipped[owner[~first]]]
+
+        view.frame.resize(rowCount+len(extraFaces))
+        frame = view.frame
+        cam.count('tempFaces', len(extraFaces))
+
+        frame.faces[:rowCount] = visibleFaces
+        frame.faces[rowCount:frame.size] = extraFaces
+        frame.local[:rowCount] = local[keep]
+        frame.local[clippedRows] = tris[first, :, :3]
+        frame.local[rowCount:frame.size] = tris[~first, :, :3]
+        if smooth:
+            frame.colours[:rowCount] = corners[keep]
+            frame.colours[clippedRows] = tris[first, :, 3:6]
+            frame.colours[rowCount:frame.size] = tris[~first, :, 3:6]
+        if textured:
+            frame.uvs[:rowCount] = uvs[keep]
+            frame.uvs[clippedRows] = tris[first, :, -2:]
+            frame.uvs[rowCount:frame.size] = tris[~first, :, -2:]
+        frame.screen[:rowCount] = view.screenPos[view.faceVertices]
+
+        # Only the clipped triangles have new points to project
+        newRows = np.concatenate([clippedRows, np.arange(rowCount, frame.size)])
+        frame.screen[newRows] = Vertex.projectPoints(frame.local[newRows].reshape(-1, 3), cam.getProjectionMatrix()).reshape(-1, 3, 2)
+        frame.depth[:frame.size] = frame.local[:frame.size, :, 2].mean(axis=1)
+
+        view.frameFaces = frame.faces[:frame.size]
+        view.frameMaterials = self.getFaceMaterials(view.frameFaces)
+        view.frameLocal = frame.local[:frame.size]
+        view.frameScreen = frame.screen[:frame.size]
+        view.frameDepth = frame.depth[:frame.size]
+        # Copy the colours, so relighting the mesh doesn't change a frame which is still being drawn
+        if smooth:
+            view.cornerColours = frame.colours[:frame.size].copy()
+            view.colours = view.cornerColours.mean(axis=1)
+        else:
+            view.colours = colours[view.faceRows[view.frameFaces]]
+        view.frameUVs = frame.uvs[:frame.size].copy() if textured else np.zeros((frame.size, 3, 2))
+
+        # Hidden faces keep their last depth, so they are close to the right place in the order when they return
+        view.faceDepth[visibleFaces] = view.frameDepth[:rowCount]
+        cam.timeStage('clip', start)
 
-        # Calculate the angle
-        # z/x
-        xtheta = fixTan(point[2], point[0])+camera.rot[0]
-        # xzMag
-        xzMag = math.sqrt(point[2]**2+point[0]**2)
+    def checkLighting(self, cam):
+        '''
+        Forget the cached colours if a light or material has changed since they were lit
+        '''
+        lightingKey = (cam.lightState, tuple(material.getState() for material in self.materials))
+        if lightingKey != self._lightingKey:
+            self._lightingKey = lightingKey
+            self._lit[:] = False
+            self._vertexLit[:] = False
+
+    def shadeFaces(self, cam, faces):
+        '''
+        Light the given faces which don't have an up to date colour, returning the (N, 3) colours of the faces
+        Flat lighting doesn't depend on the camera, so the colours are kept between frames
+        '''
+        self.checkLighting(cam)
+
+        needsLight = np.zeros(len(self.faces), dtype=bool)
+        needsLight[faces] = True
+        needsLight &= ~self._lit
+        if needsLight.any():
+            # Light every face of each material against every light at once
+            lights = cam.scene.getLights()
+            shadows = cam.scene.getShadowMaps()
+            for m, material in enumerate(self.materials):
+                lit = np.flatnonzero(needsLight & (self.faceMaterials == m))
+                if len(lit):
+                    self.faceColours[lit] = material.getColours(self.globalCentres[lit], self.globalNormals[lit], lights, shadows)
+            self._lit |= needsLight
+
+        return self.faceColours[faces]
+
+    def shadeVertices(self, cam, faces):
+        '''
+        Light each vertex of the given faces once for every material it is used with
+        Returns the (N, 3, 3) colours of the corners of the faces
+        '''
+        self.checkLighting(cam)
 
-        x = xzMag*math.cos(xtheta)
-        point[2] = xzMag*math.sin(xtheta)
+        materials = self.faceMaterials[faces][:, None]
+        needsLight = np.zeros(self._vertexLit.shape, dtype=bool)
+        needsLight[materials, self.faces[faces]] = True
+        needsLight &= ~self._vertexLit
 
-        # Calculate the other angle
-        ytheta = fixTan(point[1], point[2])-camera.rot[1]
+        lights = cam.scene.getLights()
+        shadows = cam.scene.getShadowMaps()
+        for m, material in enumerate(self.materials):
+            vertices = np.flatnonzero(needsLight[m])
+            if len(vertices):
+                self.vertexColours[m, vertices] = material.getColours(self.positions[vertices], self.vertexNormals[vertices], lights, shadows)
+        self._vertexLit |= needsLight
 
-        zyMag = math.sqrt(point[2]**2+point[1]**2)
+        return self.vertexColours[materials, self.faces[faces]]
 
-        y = zyMag*math.sin(ytheta)
-        z = zyMag*math.cos(ytheta)
+    def backFaceCull(self, cam):
+        '''
+        Return whether or not each face has successfully escaped backface culling
+        Faces are culled when their normal points back towards the camera
+        '''
+        view = self.globalCentres-cam.pos
+        facing = (self.globalNormals*view).sum(axis=1) >= 0
+
+        return ~self.backCull | facing
+
+class InstanceMesh(Mesh):
+    '''
+    Many copies of one shared mesh, each with its own 4x4 matrix and colour
+    Only the source mesh's arrays and a matrix and colour per instance are kept, the instances are moved into place when they are drawn
+    '''
+    def __init__(self, source):
+        super().__init__()
+        self.source = source
+        self._fromArrays = True
+
+        # The matrix which moves each instance within the object, and the colour its lit colours are tinted by
+        self.instanceMatrices = np.zeros((0, 4, 4))
+        self.instanceColours = np.zeros((0, 3))
+        # The version of the source mesh the instances were built from
+        self.sourceVersion = None
+        # Changes when the batches cameras draw the instances with have to be made again
+        self.layoutVersion = 0
+        # The world space bounding sphere of every instance, and the version they were worked out for
+        self._spheres = (None, np.zeros((0, 3)), np.zeros(0))
+
+    def addPolygon(self, poly):
+        raise ValueError('Polygons can\'t be added to an instanced mesh, add them to its source mesh.')
+
+    def setInstances(self, matrices, colours):
+        '''
+        Replace every instance with (N, 4, 4) matrices and (N, 3) colours, the mesh is rebuilt when next used
+        '''
+        self.instanceMatrices = np.array(matrices, dtype=float).reshape(-1, 4, 4)
+        self.instanceColours = np.array(colours, dtype=float).reshape(-1, 3)
+        self._dirty = True
 
-        self.localPos = [x, y, z]
+    def checkSource(self):
+        '''
+        Mark the instances to be rebuilt if the source mesh has changed since they were built from it
+        '''
+        if self.source.getVersion() != self.sourceVersion:
+            self._dirty = True
 
-        return [x, y, z]
+    def setInstance(self, index, matrix=None, colour=None):
+        '''
+        Move or recolour one instance, nothing else has to be worked out again as instances are moved into place when drawn
+        '''
+        if self._dirty:
+            self.update()
+
+        if matrix is not None:
+            self.instanceMatrices[index] = matrix
+            self.version += 1
+        if colour is not None:
+            self.instanceColours[index] = colour
+
+    def _build(self):
+        '''
+        Take the materials of the source mesh, its geometry is only moved into place for the instances being drawn
+        '''
+        self.sourceVersion = self.source.getVersion()
+        self.materials = self.source.materials
+        self._place()
+
+    def _place(self):
+        '''
+        Mark every batch of the instances as out of date, the instances or the source mesh have changed
+        '''
+        self.layoutVersion += 1
+        self._dirty = False
+        self.version += 1
+
+    def getWorldMatrices(self, instances=slice(None)):
+        '''
+        Get the (N, 4, 4) matrices which move the source mesh straight into world space as some of the instances
+        '''
+        return self.matrix @ self.instanceMatrices[instances]
+
+    def getInstanceSpheres(self):
+        '''
+        Get the (N, 3) centres and (N,) radii of a bounding sphere around each instance in world space
+        '''
+        if self._dirty:
+            self.update()
+        if self._spheres[0] != self.version:
+            points = self.source.localPositions
+            if len(points):
+                centre = (points.min(axis=0)+points.max(axis=0))/2
+                radius = np.sqrt(((points-centre)**2).sum(axis=1).max())
+            else:
+                centre, radius = np.zeros(3), 0
+
+            # A sphere grows by the largest amount the matrix stretches anything
+            matrices = self.getWorldMatrices()
+            centres = applyMatrices(matrices, centre[None])[:, 0]
+            radii = radius*np.linalg.norm(matrices[:, :3, :3], 2, axis=(1, 2)) if len(matrices) else np.zeros(0)
+            self._spheres = (self.version, centres, radii)
+        return self._spheres[1:]
+
+    def getBoundingPoints(self):
+        '''
+        Get the corners of the source mesh's bounding box around every instance
+        '''
+        if self._dirty:
+            self.update()
+        points = self.source.localPositions
+        if not len(points) or not len(self.instanceMatrices):
+            return np.zeros((0, 3))
+        low, high = points.min(axis=0), points.max(axis=0)
+        corners = np.array([[x, y, z] for x in (low[0], high[0]) for y in (low[1], high[1]) for z in (low[2], high[2])])
+        return applyMatrices(self.getWorldMatrices(), corners).reshape(-1, 3)
+
+    def getWorldTriangles(self):
+        '''
+        Get the (N*F, 3, 3) world space corners of every face of every instance, made for the caller and not kept
+        '''
+        if self._dirty:
+            self.update()
+        source = self.source
+        return applyMatrices(self.getWorldMatrices(), source.localPositions[source.faces].reshape(-1, 3)).reshape(-1, 3, 3)
+
+    def getWorldHardEdges(self):
+        '''
+        Get the (N*H, 2, 3) world space ends of every hard edge of every instance, made for the caller and not kept
+        '''
+        if self._dirty:
+            self.update()
+        source = self.source
+        return applyMatrices(self.getWorldMatrices(), source.localPositions[source.getHardEdges()].reshape(-1, 3)).reshape(-1, 2, 3)
+
+    def preRender(self, cam, instances=None):
+        '''
+        Move the given instances, or every instance inside the view, into place and prepare them to be drawn
+        The camera's MeshFrame keeps them as an InstanceBatch, which is only made again when different instances are drawn
+        '''
+        if self._dirty:
+            self.update()
+        if instances is None:
+            instances = np.flatnonzero(cam.areVisible(*self.getInstanceSpheres()))
+
+        view = cam.getMeshFrame(self)
+        batch = view.batch
+        if batch is None or batch.layoutVersion != self.layoutVersion or not np.array_equal(batch.instances, instances):
+            batch = InstanceBatch(self, instances)
+            view.batch = batch
+        batch.prepareFrame(cam, view)
+
+class InstanceBatch(Mesh):
+    '''
+    Some of an InstanceMesh's instances, kept by a camera's MeshFrame to draw them with like any other mesh
+    Nothing is kept per instance, each frame the source mesh is moved into place for every instance at once and only the faces drawn are lit
+    Face f is face f % F of the source mesh in the batch's (f // F)th instance, and vertices are numbered the same way
+    '''
+    def __init__(self, mesh, instances):
+        super().__init__()
+        self._fromArrays = True
+        self.mesh = mesh
+        self.source = mesh.source
+        self.instances = np.array(instances, dtype=int)
+        self.layoutVersion = mesh.layoutVersion
+        self.materials = self.source.materials
+
+        # The matrix from the source mesh into world space and the colour of each instance, taken every frame
+        self.matrices = np.zeros((0, 4, 4))
+        self.normalMatrices = np.zeros((0, 3, 3))
+        self.colours = np.zeros((0, 3))
+
+    def prepareFrame(self, cam, view):
+        '''
+        Move the instances into place as they are this frame, then prepare them like any other mesh
+        '''
+        mesh, source = self.mesh, self.source
+        self.matrices = mesh.getWorldMatrices(self.instances)
+        self.normalMatrices = getNormalMatrix(self.matrices)
+        self.colours = mesh.instanceColours[self.instances]
+        self.positions = applyMatrices(self.matrices, source.localPositions).reshape(-1, 3)
+
+        super().prepareFrame(cam, view)
+        # Only the source mesh is kept between frames
+        self.positions = np.zeros((0, 3))
+
+    def getFaceCount(self):
+        '''
+        Get the number of faces of every instance in the batch
+        '''
+        return len(self.instances)*len(self.source.faces)
+
+    def getFaceVertices(self, faces):
+        '''
+        Get the (N, 3) vertex indices of the given faces, each instance's vertices come after the last instance's
+        '''
+        instances, faces = np.divmod(faces, len(self.source.faces))
+        return self.source.faces[faces]+len(self.source.localPositions)*instances[:, None]
+
+    def getUVs(self, vertices):
+        '''
+        Get the texture coordinates of the given vertices from the source mesh
+        '''
+        return self.source.uvs[vertices % len(self.source.localPositions)]
+
+    def getFaceMaterials(self, faces):
+        '''
+        Get the index into materials of each of the given faces from the source mesh
+        '''
+        return self.source.faceMaterials[faces % len(self.source.faces)]
+
+    def getEdges(self):
+        '''
+        Get the source mesh's edges repeated for every instance, see Mesh.getEdges
+        '''
+        stripVertices, edgeStarts, cornerEdges, diagonal = self.source.getEdges()
+        blocks = np.arange(len(self.instances))[:, None]
+        return ((stripVertices+len(self.source.localPositions)*blocks).ravel(), (edgeStarts+len(stripVertices)*blocks).ravel(),
+                (cornerEdges+len(edgeStarts)*blocks).ravel(), np.tile(diagonal, len(self.instances)))
+
+    def backFaceCull(self, cam):
+        '''
+        Return whether or not each face has escaped backface culling, see Mesh.backFaceCull
+        The normal matrix times the linear part of a matrix is its absolute determinant, so the test can be done on the source mesh's
+        normals without moving every face centre and normal of every instance
+        '''
+        source = self.source
+        scale = np.abs(np.linalg.det(self.matrices[:, :3, :3]))
+        offsets = (self.normalMatrices @ (self.matrices[:, :3, 3]-cam.pos)[:, :, None])[:, :, 0]
+        facing = scale[:, None]*(source.localNormals*source.localCentres).sum(axis=1) + offsets @ source.localNormals.T >= 0
+
+        return (~source.backCull | facing).ravel()
+
+    def shadeFaces(self, cam, faces):
+        '''
+        Light the given faces, returning their (N, 3) colours tinted by the colour of their instances
+        Nothing is cached, so only the faces drawn are moved into world space
+        '''
+        source = self.source
+        instances, sourceFaces = np.divmod(faces, len(source.faces))
+        matrices = self.matrices[instances]
+        centres = np.einsum('nij,nj->ni', matrices[:, :3, :3], source.localCentres[sourceFaces])+matrices[:, :3, 3]
+        normals = np.einsum('nj,nji->ni', source.localNormals[sourceFaces], self.normalMatrices[instances])
+
+        return self.shade(cam, source.faceMaterials[sourceFaces], centres, normals, instances)
+
+    def shadeVertices(self, cam, faces):
+        '''
+        Light each vertex of the given faces once for every material it is used with, see Mesh.shadeVertices
+        '''
+        source = self.source
+        vertexCount = len(self.positions)
+        keys = (self.getFaceMaterials(faces)[:, None]*vertexCount+self.getFaceVertices(faces)).ravel()
+        keys, corners = np.unique(keys, return_inverse=True)
+        materials, vertices = np.divmod(keys, vertexCount)
+        instances, sourceVertices = np.divmod(vertices, len(source.localPositions))
+        normals = np.einsum('nj,nji->ni', source.localVertexNormals[sourceVertices], self.normalMatrices[instances])
+
+        colours = self.shade(cam, materials, self.positions[vertices], normals, instances)
+        return colours[corners.ravel()].reshape(-1, 3, 3)
+
+    def shade(self, cam, materials, positions, normals, instances):
+        '''
+        Light points with the given materials, positions and normals, tinted by the colour of their instances
+        '''
+        lights = cam.scene.getLights()
+        shadows = cam.scene.getShadowMaps()
+        colours = np.zeros((len(positions), 3))
+        for m, material in enumerate(self.materials):
+            points = np.flatnonzero(materials == m)
+            if len(points):
+                colours[points] = material.getColours(positions[points], normals[points], lights, shadows)*self.colours[instances[points]]/255
+        return colours
+
+class MeshFrame:
+    '''
+    The per-frame information of one mesh as seen by one camera
+    Each camera keeps its own, so cameras rendering the same mesh don't overwrite each other
+    '''
+    def __init__(self, mesh):
+        self.mesh = mesh
+        self.version = None
+
+        # Per-frame vertex information
+        self.localPos = np.zeros((0, 3))
+        self.screenPos = np.zeros((0, 2), dtype=int)
+        self.screenScale = np.zeros(0, dtype=int)
+        self.shouldRender = np.zeros(0, dtype=bool)
+
+        # Per-frame face information, one row for every face to draw this frame
+        # The rows are views into a buffer which is reused every frame
+        self.frame = FaceBuffer()
+        self.colours = np.zeros((0, 3))
+        # The colour of each corner of the rows, only used for smooth shading
+        self.cornerColours = np.zeros((0, 3, 3))
+        # The texture coordinates of each corner of the rows, only used for texturing
+        self.frameUVs = np.zeros((0, 3, 2))
+        self.frameFaces = np.zeros(0, dtype=int)
+        self.frameLocal = np.zeros((0, 3, 3))
+        self.frameScreen = np.zeros((0, 3, 2), dtype=int)
+        self.frameDepth = np.zeros(0)
+
+        # Per-frame information for every face in the mesh, used for sorting
+        self.faceDepth = np.zeros(0)
+        self.faceVisible = np.zeros(0, dtype=bool)
+        self.faceRows = np.zeros(0, dtype=int)
+        # The vertices of each visible face, and the mesh's edges when the frame was prepared, edges are only kept for wireframes
+        self.faceVertices = np.zeros((0, 3), dtype=int)
+        self.edges = None
+        # The material of each row
+        self.frameMaterials = np.zeros(0, dtype=int)
+        # The mesh whose faces were drawn, or for an InstanceMesh the batch of its instances in view
+        self.geometry = None
+        self.batch = None
+
+    def update(self, geometry):
+        '''
+        Resize the per-face arrays if the mesh being drawn has been rebuilt, or different instances are being drawn
+        '''
+        if geometry is not self.geometry or self.version != geometry.version:
+            self.geometry = geometry
+            self.version = geometry.version
+            self.faceDepth = np.zeros(geometry.getFaceCount())
+
+    def renderWireframe(self, cam):
+        '''
+        Render the edges of this frame's visible faces, drawing each edge only once
+        Unbroken runs of visible edges along the mesh's edge strips are drawn as one line each
+        The parts of edges behind the near plane or past the far plane are clipped off, and diagonals are left out unless the camera shows them
+        Frames prepared before the camera switched to a wireframe have no edges, so nothing is drawn for them
+        '''
+        if self.edges is None:
+            return
+        stripVertices, edgeStarts, cornerEdges, diagonal = self.edges
+        shown = np.zeros(len(edgeStarts), dtype=bool)
+        shown[cornerEdges[np.repeat(self.faceVisible, 3)]] = True
+        if not cam.showDiagonals:
+            shown &= ~diagonal
+
+        # Walk the shown edges in strip order
+        segments = np.sort(edgeStarts[shown])
+        depth = self.localPos[stripVertices, 2]
+        startDepth, endDepth = depth[segments], depth[segments+1]
+        inside = (np.minimum(startDepth, endDepth) >= NEAR_CLIP) & (np.maximum(startDepth, endDepth) <= FAR_CLIP)
+
+        # A run starts at every edge which doesn't carry on from the edge before it
+        whole = segments[inside]
+        if len(whole):
+            runStarts = np.flatnonzero(np.diff(whole, prepend=-2) != 1)
+            runEnds = np.append(runStarts[1:], len(whole))
+            for first, last in zip(whole[runStarts].tolist(), whole[runEnds-1].tolist()):
+                pygame.draw.lines(cam.screen, (0, 0, 0), False, self.screenPos[stripVertices[first:last+2]].tolist(), 3)
+
+        # Edges crossing the near or far plane are clipped and drawn on their own
+        crossing = segments[~inside]
+        if not len(crossing):
+            return
+        starts, ends, inside = clipSegmentDepths(self.localPos[stripVertices[crossing]], self.localPos[stripVertices[crossing+1]], NEAR_CLIP, FAR_CLIP)
+        points = np.stack([starts[inside], ends[inside]], axis=1)
+        for line in Vertex.projectPoints(points.reshape(-1, 3), cam.getProjectionMatrix()).reshape(-1, 2, 2).tolist():
+            pygame.draw.line(cam.screen, (0, 0, 0), line[0], line[1], 3)
+
+    def renderDots(self, cam):
+        '''
+        Render a dot at every vertex of this frame's visible faces which should be drawn, once however many faces share it
+        '''
+        used = np.zeros(len(self.shouldRender), dtype=bool)
+        used[self.faceVertices] = True
+        used &= self.shouldRender
+        for centre, radius in zip(self.screenPos[used].tolist(), self.screenScale[used].tolist()):
+            pygame.draw.circle(cam.screen, (0, 0, 0), centre, radius)
+
+    def renderFace(self, cam, row):
+        '''
+        Render one of this frame's faces to the given camera's screen
+        '''
+        colour = self.colours[row].tolist()
+        screenPoints = self.frameScreen[row].tolist()
+
+        if cam.renderMode == SHADED:
+            # Render according to the camera's shading mode
+            try:
+                if cam.shadingMode == FLAT:
+                    pygame.draw.polygon(cam.screen, colour, screenPoints)
+                elif cam.shadingMode == SMOOTH_GOURAUD:
+                    # Smooth faces are all rasterised at once by the camera
+                    pass
+                elif cam.shadingMode == SMOOTH_PHONG:
+                    pass
+            except TypeError:
+                pass
+
+        elif cam.renderMode == TEXTURED:
+            try:
+                if self.mesh.materials[self.frameMaterials[row]].isColour():
+                    # No image and UVs set for this poly.
+                    pygame.draw.polygon(cam.screen, colour, screenPoints)
+                else:
+                    # Textured faces are all rasterised at once by the camera
+                    pass
+            except TypeError:
+                pass
+
+        # render hard edges on the polygon if option set, wireframes are drawn all at once by the camera
+        if POLY_OUTLINE == HARD_OUTLINE and cam.renderMode in [SHADED, TEXTURED]:
+            self.renderOutline(cam, row)
+
+    def renderOutline(self, cam, row):
+        '''
+        Render the edges of one of this frame's faces over the faces drawn before it
+        '''
+        screenPoints = self.frameScreen[row].tolist()
+
+        try:
+            pygame.draw.lines(cam.screen, (0, 0, 0), True, screenPoints, 3)
+        except TypeError:
+            pass
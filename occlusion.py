@@ -0,0 +1,114 @@
+import numpy as np
+
+from objects_3d import *
+from rasteriser import ZBuffer
+
+# How many screen pixels wide each pixel of the bottom level of the depth pyramid is
+OCCLUSION_SCALE = 8
+# The most pyramid pixels across a bounding box can cover in the level it is tested against
+OCCLUSION_TEST_SIZE = 4
+
+class DepthPyramid:
+    '''
+    A coarse depth buffer of the occluders in a camera's view, with smaller levels which keep the furthest depth of each 2x2 block
+    Bounding boxes are tested against the level where they only cover a few pixels, so every test costs about the same
+    Every level is conservative, a pixel only has a depth if the occluders cover all of it at least that close
+    '''
+    def __init__(self, screenSize, scale=OCCLUSION_SCALE):
+        self.scale = scale
+        self.size = (max(-(-screenSize[0]//scale), 1), max(-(-screenSize[1]//scale), 1))
+        self.levels = []
+
+    def build(self, triangles, hardEdges, view, projection):
+        '''
+        Rasterise (T, 3, 3) world space triangles into the bottom level and build the levels above it
+        The (H, 2, 3) hard edges are the edges of the occluders' surfaces and creases, where a gap or a change of plane could be
+        '''
+        # Sample the occluders at the corners of the pixels, one more row and column than there are pixels
+        corners = ZBuffer((self.size[0]+1, self.size[1]+1))
+        if len(triangles):
+            # Clip to the near and far planes, the rasteriser skips anything off the screen
+            local = applyMatrix(view, triangles.reshape(-1, 3)).reshape(-1, 3, 3)
+            planes = getClipPlanes(NEAR_CLIP, FAR_CLIP)
+            rejected, crossing = classifyFaces(local, planes)
+            polys, counts = clipPolygons(local[~rejected], planes)
+            local, owner, fanIndex = triangulateFans(polys, counts)
+
+            screenPos = Vertex.projectPoints(local.reshape(-1, 3), projection).reshape(-1, 3, 2)/self.scale
+            corners.drawTriangles(screenPos, 1/local[:, :, 2], np.zeros((len(local), 3)))
+
+        # Away from the hard edges the occluders are flat, so 1/z is linear across a pixel and furthest at one of its corners
+        # Depths are stored as 1/z, so the furthest depth is the smallest value and empty pixels are 0
+        depth = corners.depth
+        level = np.minimum(np.minimum(depth[:-1, :-1], depth[1:, :-1]), np.minimum(depth[:-1, 1:], depth[1:, 1:]))
+        level[self._getEdgePixels(hardEdges, view, projection)] = 0
+
+        self.levels = [level]
+        while max(level.shape) > 1:
+            # Past the edge of the screen can't be seen, so odd sizes are padded with the pixels along the edge
+            padded = np.pad(level, ((0, level.shape[0] % 2), (0, level.shape[1] % 2)), mode='edge')
+            level = np.minimum(np.minimum(padded[0::2, 0::2], padded[1::2, 0::2]), np.minimum(padded[0::2, 1::2], padded[1::2, 1::2]))
+            self.levels.append(level)
+
+    def _getEdgePixels(self, edges, view, projection):
+        '''
+        Get a mask of every pixel which any of the (H, 2, 3) world space edges might pass through
+        Each edge is stepped along half a pixel at a time, and the pixels around every step are marked
+        '''
+        mask = np.zeros(self.size, dtype=bool)
+        if not len(edges):
+            return mask
+
+        # Clip the edges to the part between the near and far planes
+        local = applyMatrix(view, edges.reshape(-1, 3)).reshape(-1, 2, 3)
+        starts, ends, inside = clipSegmentDepths(local[:, 0], local[:, 1], NEAR_CLIP, FAR_CLIP)
+        count = np.count_nonzero(inside)
+        points = np.concatenate([starts[inside], ends[inside]])
+
+        # Only the part of each edge near the screen needs stepping along
+        screenPos = Vertex.projectPoints(points, projection)/self.scale
+        starts, ends, inside = clipSegments(screenPos[:count], screenPos[count:], (-1, -1), self.size)
+        starts, ends = starts[inside], ends[inside]
+
+        steps = np.ceil(2*np.abs(ends-starts).max(axis=1)).astype(int)+1
+        edge = np.repeat(np.arange(len(starts)), steps)
+        t = (np.arange(steps.sum())-np.repeat(np.cumsum(steps)-steps, steps))/np.maximum(steps-1, 1)[edge]
+        pixels = np.floor(starts[edge]+(ends-starts)[edge]*t[:, None]).astype(int)
+
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                around = pixels+(dx, dy)
+                around = around[((around >= 0) & (around < self.size)).all(axis=1)]
+                mask[around[:, 0], around[:, 1]] = True
+        return mask
+
+    def isOccluded(self, bounds, view, projection):
+        '''
+        Check whether a bounding volume is completely hidden behind the occluders
+        Boxes crossing the near plane are never hidden
+        '''
+        if bounds is None or not self.levels:
+            return False
+        low, high = bounds[0], bounds[1]
+
+        corners = np.array([[x, y, z] for x in (low[0], high[0]) for y in (low[1], high[1]) for z in (low[2], high[2])])
+        local = applyMatrix(view, corners)
+        nearest = local[:, 2].min()
+        if nearest <= NEAR_CLIP:
+            return False
+
+        # Grow the box by a pixel, since its corners were rounded to the nearest screen pixel
+        # Any of it off the screen can't be seen anyway, so only the part on the screen is tested
+        screenPos = Vertex.projectPoints(local, projection)
+        start = np.maximum(np.floor(screenPos.min(axis=0)/self.scale).astype(int)-1, 0)
+        end = np.minimum(np.floor(screenPos.max(axis=0)/self.scale).astype(int)+1, np.array(self.size)-1)
+        if (start > end).any():
+            return False
+
+        # Pick the level where the box covers at most a few pixels across
+        span = max(end-start)+1
+        l = min(max(int(np.ceil(np.log2(span/OCCLUSION_TEST_SIZE))), 0), len(self.levels)-1)
+        start, end = start >> l, end >> l
+
+        # Hidden if the occluders are closer than the nearest point of the box everywhere it covers
+        return bool((self.levels[l][start[0]:end[0]+1, start[1]:end[1]+1] > 1/nearest).all())
@@ -0,0 +1,67 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from scene_objects import *
+
+# Every pipeline prepares frames on the same thread, so the meshes shared between cameras only change one frame at a time
+WORKER = ThreadPoolExecutor(1)
+
+class FramePipeline:
+    '''
+    Prepares the next frame of a camera on a worker thread while the current one is drawn
+    Two copies of the camera take turns, so the frame being drawn is never changed by the one being prepared
+    Frames are shown one frame after the camera's position and rotation are read
+    '''
+    def __init__(self, cam):
+        self.cam = cam
+        self.buffers = [cam.copy(), cam.copy()]
+        self.next = 0
+        self.pending = None
+
+    def prepare(self):
+        '''
+        Start preparing a frame from a snapshot of the camera and scene
+        '''
+        buffer = self.buffers[self.next]
+        self.next = 1-self.next
+
+        buffer.pos = list(self.cam.pos)
+        buffer.rot = list(self.cam.rot)
+        buffer.rasterMode = self.cam.rasterMode
+        buffer.shadingMode = self.cam.shadingMode
+        buffer.renderMode = self.cam.renderMode
+        buffer.occlusionCulling = self.cam.occlusionCulling
+        buffer.showDiagonals = self.cam.showDiagonals
+        buffer.screen = self.cam.screen
+        buffer.scene = self.cam.scene.snapshot()
+        buffer.tempFaces = self.cam.tempFaces
+        self.cam.tempFaces = []
+
+        self.pending = WORKER.submit(self._preRender, buffer)
+
+    @staticmethod
+    def _preRender(buffer):
+        buffer.preRender()
+        return buffer
+
+    def renderFrame(self):
+        '''
+        Draw the prepared frame to the camera's screen, and start preparing the next one
+        '''
+        if self.cam.scene is None:
+            raise ValueError('The scene has not been set for this camera!')
+
+        if self.pending is None:
+            self.prepare()
+        buffer = self.pending.result()
+        self.prepare()
+
+        self.cam.useFrame(buffer)
+        self.cam.renderScene()
+
+    def wait(self):
+        '''
+        Wait for the frame being prepared to finish
+        Must be called before changing the scene's geometry with updateVertices
+        '''
+        if self.pending is not None:
+            self.pending.result()
@@ -0,0 +1,312 @@
+import pygame
+import numpy as np
+from multiprocessing import Pool
+
+from objects_3d import NEAR_CLIP
+
+# The most candidate pixels to test in one batch of triangles
+MAX_BATCH_PIXELS = 2**21
+# The size of the screen tiles which are rasterised in parallel
+TILE_SIZE = (256, 256)
+
+def getMeshTriangles(meshes, smooth=False, rows=None):
+    '''
+    Gather the faces the MeshFrames have to draw this frame
+    Returns their (K, 3, 2) screen positions, (K, 3) inverse depths and (K, 3) colours
+    If smooth is set, the colours are the (K, 3, 3) colours of each corner instead
+    Only the given rows of each MeshFrame are gathered if a list of them is given
+    '''
+    if rows is None:
+        rows = [slice(None)]*len(meshes)
+    if not meshes:
+        return np.zeros((0, 3, 2)), np.zeros((0, 3)), np.zeros((0, 3, 3) if smooth else (0, 3))
+
+    screenPos = np.concatenate([mesh.frameScreen[meshRows] for mesh, meshRows in zip(meshes, rows)])
+    invDepth = 1/np.maximum(np.concatenate([mesh.frameLocal[meshRows, :, 2] for mesh, meshRows in zip(meshes, rows)]), NEAR_CLIP)
+    colours = np.clip(np.concatenate([(mesh.cornerColours if smooth else mesh.colours)[meshRows] for mesh, meshRows in zip(meshes, rows)]), 0, 255)
+    return screenPos, invDepth, colours
+
+def getMeshTextures(meshes, rows=None):
+    '''
+    Gather the textures of the faces the MeshFrames have to draw this frame
+    Returns their (K, 3, 2) texture coordinates, a list of the textures used, and the index of each face's texture in it
+    Faces without a texture use the None in the list
+    '''
+    if rows is None:
+        rows = [slice(None)]*len(meshes)
+
+    textures = [None]
+    index = {id(None): 0}
+    faceTextures = []
+    for mesh, meshRows in zip(meshes, rows):
+        lookup = []
+        for material in mesh.mesh.materials:
+            texture = material.getTexture()
+            if id(texture) not in index:
+                index[id(texture)] = len(textures)
+                textures.append(texture)
+            lookup.append(index[id(texture)])
+        faceTextures.append(np.array(lookup, dtype=int)[mesh.frameMaterials[meshRows]])
+
+    if not meshes:
+        return np.zeros((0, 3, 2)), textures, np.zeros(0, dtype=int)
+    uvs = np.concatenate([mesh.frameUVs[meshRows] for mesh, meshRows in zip(meshes, rows)])
+    return uvs, textures, np.concatenate(faceTextures)
+
+def drawMeshFrames(buffer, meshes, smooth=False, textured=False, rows=None, depths=None):
+    '''
+    Rasterise the faces of MeshFrames into a ZBuffer or TiledRasteriser
+    Faces are depth tested with their inverse depths, unless a (K,) array of larger-is-closer depths is given
+    '''
+    screenPos, invDepth, colours = getMeshTriangles(meshes, smooth, rows)
+    keys = invDepth if depths is None else np.repeat(np.asarray(depths, dtype=float)[:, None], 3, axis=1)
+    if not textured:
+        buffer.drawTriangles(screenPos, keys, colours)
+        return
+
+    # Each texture is drawn in its own batch
+    uvs, textures, faceTextures = getMeshTextures(meshes, rows)
+    uvw = np.concatenate([uvs*invDepth[:, :, None], invDepth[:, :, None]], axis=2)
+    for t, texture in enumerate(textures):
+        faces = np.flatnonzero(faceTextures == t)
+        if len(faces):
+            buffer.drawTriangles(screenPos[faces], keys[faces], colours[faces], uvw[faces], texture)
+
+def drawTile(task):
+    '''
+    Rasterise the triangles covering one tile of the screen, run in a worker process
+    Returns the tile's colour and depth buffers
+    '''
+    origin, size, *triangles = task
+    buffer = ZBuffer(size, origin)
+    buffer.drawTriangles(*triangles)
+    return buffer.colour, buffer.depth
+
+class ZBuffer:
+    '''
+    A colour buffer and depth buffer which triangles are rasterised into with NumPy
+    '''
+    def __init__(self, size, origin=(0, 0)):
+        self.size = tuple(size)
+        # The screen position of the buffer's top left pixel
+        self.origin = tuple(origin)
+        # Buffers are indexed [x, y] to match pygame.surfarray
+        self.colour = np.zeros(self.size+(3,), dtype=np.uint8)
+        # Stores 1/z, so 0 is infinitely far away and larger values are closer
+        self.depth = np.zeros(self.size)
+
+    def clear(self):
+        '''
+        Reset the depth buffer for a new frame
+        '''
+        self.depth.fill(0)
+
+    def drawMesh(self, mesh):
+        '''
+        Rasterise all of the faces a MeshFrame has to draw this frame
+        '''
+        self.drawTriangles(*getMeshTriangles([mesh]))
+
+    def drawMeshes(self, meshes, smooth=False, textured=False, rows=None, depths=None):
+        '''
+        Rasterise the faces of several meshes together, see drawMeshFrames
+        '''
+        drawMeshFrames(self, meshes, smooth, textured, rows, depths)
+
+    def drawTriangles(self, screenPos, invDepth, colours, uvw=None, texture=None):
+        '''
+        Rasterise (K, 3, 2) screen positions with (K, 3) inverse depths and (K, 3) colours
+        Colours can also be (K, 3, 3), one for each corner, which are blended across the triangles
+        With a texture, (K, 3, 3) corners of (u/z, v/z, 1/z) give perspective correct texture coordinates
+        and the texture is tinted by the colours
+        Every candidate pixel in the triangles' bounding boxes is tested at once, in batches
+        '''
+        # Everything is worked out in screen positions, so a tile of the screen rasterises its pixels exactly as the whole screen would
+        screenPos = np.asarray(screenPos, dtype=float)
+        levels = None if texture is None else texture.getLevels(uvw[:, :, :2]/uvw[:, :, 2:], screenPos)
+
+        # Get the bounding boxes, clamped to the buffer
+        low = np.maximum(np.floor(screenPos.min(axis=1)), self.origin).astype(int)
+        high = np.minimum(np.ceil(screenPos.max(axis=1)), np.add(self.origin, self.size)-1).astype(int)
+        widths = high[:, 0]-low[:, 0]+1
+        heights = high[:, 1]-low[:, 1]+1
+
+        # Twice the signed area of each triangle, degenerate ones cover nothing
+        a, b, c = screenPos[:, 0], screenPos[:, 1], screenPos[:, 2]
+        area = (b[:, 0]-a[:, 0])*(c[:, 1]-a[:, 1]) - (b[:, 1]-a[:, 1])*(c[:, 0]-a[:, 0])
+
+        valid = np.flatnonzero((widths > 0) & (heights > 0) & (area != 0))
+        counts = widths[valid]*heights[valid]
+
+        # Split the triangles into batches of roughly MAX_BATCH_PIXELS candidates
+        ends = np.cumsum(counts)
+        start = 0
+        while start < len(valid):
+            stop = max(np.searchsorted(ends, ends[start]-counts[start]+MAX_BATCH_PIXELS, 'right'), start+1)
+            self._drawBatch(valid[start:stop], counts[start:stop], screenPos, area, low, widths, invDepth, colours, uvw, texture, levels)
+            start = stop
+
+    def _drawBatch(self, tris, counts, screenPos, area, low, widths, invDepth, colours, uvw, texture, levels):
+        '''
+        Rasterise a batch of triangles into the buffers
+        '''
+        # Generate every row of every bounding box
+        heights = counts//widths[tris]
+        rowOwner = np.repeat(tris, heights)
+        rowY = low[rowOwner, 1] + np.arange(heights.sum()) - np.repeat(np.cumsum(heights)-heights, heights)
+
+        # Find where each row enters and leaves its triangle
+        left = np.full(len(rowY), np.inf)
+        right = np.full(len(rowY), -np.inf)
+        for p, q in ((0, 1), (1, 2), (2, 0)):
+            start, end = screenPos[rowOwner, p], screenPos[rowOwner, q]
+            dy = end[:, 1]-start[:, 1]
+            crosses = (dy != 0) & (rowY >= np.minimum(start[:, 1], end[:, 1])) & (rowY <= np.maximum(start[:, 1], end[:, 1]))
+            x = start[:, 0] + (rowY-start[:, 1])*(end[:, 0]-start[:, 0])/np.where(dy == 0, 1, dy)
+            left = np.where(crosses, np.minimum(left, x), left)
+            right = np.where(crosses, np.maximum(right, x), right)
+
+        # Rows are interpolated from where they start on the screen, even when the buffer is a tile starting further along
+        rowStart = np.maximum(np.ceil(left), 0)
+        spanStart = np.maximum(rowStart, self.origin[0])
+        spanEnd = np.minimum(np.floor(right), self.origin[0]+self.size[0]-1)
+        spans = np.maximum(spanEnd-spanStart+1, 0).astype(int)
+
+        # Only the rows which cross their triangle have any pixels
+        rows = np.flatnonzero(spans)
+        rowOwner, rowY, rowStart, spanStart, spans = rowOwner[rows], rowY[rows], rowStart[rows], spanStart[rows], spans[rows]
+
+        # The barycentric weights and 1/z are linear in screen space, so get them at the start of each row
+        # and how much they change for each pixel along it
+        a, b, c = screenPos[rowOwner, 0], screenPos[rowOwner, 1], screenPos[rowOwner, 2]
+        rowArea = area[rowOwner]
+        w0 = ((c[:, 0]-b[:, 0])*(rowY-b[:, 1]) - (c[:, 1]-b[:, 1])*(rowStart-b[:, 0]))/rowArea
+        w1 = ((a[:, 0]-c[:, 0])*(rowY-c[:, 1]) - (a[:, 1]-c[:, 1])*(rowStart-c[:, 0]))/rowArea
+        w0Step = (b[:, 1]-c[:, 1])/rowArea
+        w1Step = (c[:, 1]-a[:, 1])/rowArea
+
+        def interpolate(corners):
+            '''
+            Get the values at the start of each row, and their change per pixel, of (R, 3, C) values at the corners
+            '''
+            first, second, third = corners[:, 0], corners[:, 1], corners[:, 2]
+            return (third + w0[:, None]*(first-third) + w1[:, None]*(second-third),
+                    w0Step[:, None]*(first-third) + w1Step[:, None]*(second-third))
+
+        depthStart, depthStep = interpolate(invDepth[rowOwner][:, :, None])
+        depthStart, depthStep = depthStart[:, 0], depthStep[:, 0]
+
+        # Generate every pixel inside the triangles
+        row = np.repeat(np.arange(len(spans)), spans)
+        offset = np.arange(spans.sum()) - np.repeat(np.cumsum(spans)-spans-(spanStart-rowStart).astype(int), spans)
+        depth = np.repeat(depthStart, spans) + np.repeat(depthStep, spans)*offset
+        pixel = np.repeat((rowStart.astype(int)-self.origin[0])*self.size[1] + rowY-self.origin[1], spans) + offset*self.size[1]
+
+        # Depth test against what has already been drawn
+        depthBuffer = self.depth.ravel()
+        closer = np.flatnonzero(depth > depthBuffer[pixel])
+        row, offset, pixel, depth = row[closer], offset[closer], pixel[closer], depth[closer]
+
+        # Keep only the closest candidate for each pixel
+        # Of candidates at the same depth the first triangle wins, as it does against earlier batches, so how the triangles are split can't change the image
+        np.maximum.at(depthBuffer, pixel, depth)
+        closest = np.flatnonzero(depth == depthBuffer[pixel])
+        # The candidates are in triangle order, so sorted by pixel then by their index the first of each pixel is the one to keep
+        # Both are packed into one key, as a plain sort is much quicker than a stable argsort, and only the candidates are sorted
+        bits = max(int(len(closest)-1).bit_length(), 1)
+        keys = np.sort((pixel[closest] << bits) | np.arange(len(closest)))
+        pixels = keys >> bits
+        firsts = np.empty(len(keys), dtype=bool)
+        firsts[:1] = True
+        np.not_equal(pixels[1:], pixels[:-1], out=firsts[1:])
+        # The kept candidates stay in their own order, which follows the rows and is quicker to gather from
+        keep = np.zeros(len(closest), dtype=bool)
+        keep[keys[firsts] & ((1 << bits)-1)] = True
+        closest = closest[keep]
+        row, offset, pixel = row[closest], offset[closest], pixel[closest]
+        owner = rowOwner[row]
+
+        if texture is not None:
+            # u/z, v/z and 1/z are linear in screen space, dividing them gives perspective correct coordinates
+            uvwStart, uvwStep = interpolate(uvw[rowOwner])
+            blended = np.take(uvwStart, row, axis=0) + np.take(uvwStep, row, axis=0)*offset[:, None]
+            texels = texture.sample(blended[:, 0]/blended[:, 2], blended[:, 1]/blended[:, 2], levels[owner])
+            self.colour.reshape(-1, 3)[pixel] = texels*colours[owner]/255
+        elif colours.ndim == 3:
+            # Gouraud shading, the colours are linear in screen space too
+            colourStart, colourStep = interpolate(colours[rowOwner].astype(np.float32))
+            blended = np.take(colourStart, row, axis=0) + np.take(colourStep, row, axis=0)*offset[:, None].astype(np.float32)
+            self.colour.reshape(-1, 3)[pixel] = np.clip(blended, 0, 255)
+        else:
+            self.colour.reshape(-1, 3)[pixel] = colours[owner]
+
+    def blit(self, surface):
+        '''
+        Copy every pixel that was drawn this frame onto a pygame surface
+        '''
+        pixels = pygame.surfarray.pixels3d(surface)
+        np.copyto(pixels, self.colour, where=(self.depth > 0)[:, :, None])
+        del pixels
+
+class TiledRasteriser:
+    '''
+    Splits the screen into tiles which are rasterised in a pool of worker processes, then composited
+    Each worker is sent a read-only copy of just the triangles covering its tile
+    '''
+    def __init__(self, size, workers=None, tileSize=TILE_SIZE):
+        self.size = tuple(size)
+        self.buffer = ZBuffer(self.size)
+        self.workers = workers
+        self.pool = None
+
+        self.tiles = []
+        for x in range(0, self.size[0], tileSize[0]):
+            for y in range(0, self.size[1], tileSize[1]):
+                self.tiles.append(((x, y), (min(tileSize[0], self.size[0]-x), min(tileSize[1], self.size[1]-y))))
+
+    def clear(self):
+        self.buffer.clear()
+
+    def drawMeshes(self, meshes, smooth=False, textured=False, rows=None, depths=None):
+        '''
+        Rasterise the faces of several meshes together, see drawMeshFrames
+        '''
+        drawMeshFrames(self, meshes, smooth, textured, rows, depths)
+
+    def drawTriangles(self, screenPos, invDepth, colours, uvw=None, texture=None):
+        '''
+        Rasterise triangles across the tiles, see ZBuffer.drawTriangles
+        '''
+        if not len(screenPos):
+            return
+        if self.pool is None:
+            self.pool = Pool(self.workers)
+
+        low = screenPos.min(axis=1)
+        high = screenPos.max(axis=1)
+
+        # Bin the triangles into every tile their bounding box touches
+        tasks = []
+        for origin, size in self.tiles:
+            inside = np.flatnonzero((high[:, 0] >= origin[0]) & (low[:, 0] <= origin[0]+size[0]-1) &
+                                    (high[:, 1] >= origin[1]) & (low[:, 1] <= origin[1]+size[1]-1))
+            if len(inside):
+                tasks.append((origin, size, screenPos[inside], invDepth[inside], colours[inside],
+                              None if uvw is None else uvw[inside], texture))
+
+        for (origin, size, *triangles), (colour, depth) in zip(tasks, self.pool.map(drawTile, tasks)):
+            area = (slice(origin[0], origin[0]+size[0]), slice(origin[1], origin[1]+size[1]))
+            closer = depth > self.buffer.depth[area]
+            self.buffer.depth[area] = np.where(closer, depth, self.buffer.depth[area])
+            np.copyto(self.buffer.colour[area], colour, where=closer[:, :, None])
+
+    def blit(self, surface):
+        self.buffer.blit(surface)
+
+    def close(self):
+        '''
+        Shut down the worker processes
+        '''
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
@@ -1,19 +1,86 @@
 import pygame
+import numpy as np
 
 import math
-from time import time
+import copy
+from weakref import WeakKeyDictionary
+from time import time, perf_counter
+from heapq import merge
+from operator import itemgetter
 
-from objects_3d import Triangle
+from objects_3d import *
+from rasteriser import ZBuffer, TiledRasteriser
+from shadows import ShadowMap
+from decimation import decimateMesh
+from occlusion import DepthPyramid
+
+# The stages of a frame which are timed
+STAGES = ('cull', 'transform', 'clip', 'shade', 'sort', 'raster')
+# The things counted during a frame
+COUNTERS = ('objects', 'culledObjects', 'vertices', 'culledFaces', 'rejectedFaces', 'clippedFaces', 'tempFaces', 'drawnFaces', 'reducedObjects', 'occludedObjects')
+
+# Whether cameras skip objects hidden behind occluders by default
+OCCLUSION_CULLING = True
+
+# The projected sizes in pixels below which each level of detail made by Object.generateLODs is used
+LOD_SIZES = (160, 60, 20)
+# How far past a level's size an object has to go before it changes level, as a fraction of the size, so objects near it don't flicker between levels
+LOD_HYSTERESIS = 0.2
+
+# Seconds between redraws of the debug overlay
+OVERLAY_INTERVAL = 0.25
 
 class Camera:
-    def __init__(self, pos, rot, screen):
+    def __init__(self, pos, rot, screen=None):
         self.rot = rot
         self.pos = pos
         self.fps = 0
-        self.screen = screen
+        # Without a screen, render to an offscreen surface which doesn't need a display
+        self.screen = pygame.Surface(SCREEN_SIZE) if screen is None else screen
         self.scene = None
         self.sortedFaces = []
         self.tempFaces = []
+        # Triangles for addFrameTriangle, reused every frame
+        self.facePool = TrianglePool()
+        self.frameObjects = []
+        self.frameMeshes = []
+        self.faceOrder = np.zeros(0, dtype=int)
+        self.orderMeshes = []
+
+        # This camera's per-frame information for each mesh and primitive it has rendered
+        self.meshFrames = WeakKeyDictionary()
+        self.primitiveFrames = WeakKeyDictionary()
+        # The level of detail each object was last drawn with by this camera
+        self.lodLevels = WeakKeyDictionary()
+
+        # The view and projection matrices, kept until the camera moves or its screen changes size
+        self._viewMatrix = None
+        self._viewKey = None
+        self._projectionMatrix = None
+        self._projectionKey = None
+
+        self.lightState = ()
+
+        # Seconds spent in each stage of the last frame, and the counts of the work done
+        self.stageTimes = dict.fromkeys(STAGES, 0)
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.statsCallbacks = []
+
+        self.debugFont = None
+        self.overlay = None
+        self.overlayTime = 0
+
+        self.rasterMode = RASTER_MODE
+        self.shadingMode = SHADING_MODE
+        self.renderMode = RENDER_MODE
+        self.zBuffer = None
+        # Worker processes to rasterise screen tiles with, 0 rasterises in this process
+        self.workers = 0
+        # Skip objects hidden behind occluders, using a depth pyramid of the occluders rebuilt every frame
+        self.occlusionCulling = OCCLUSION_CULLING
+        self.depthPyramid = None
+        # Whether wireframes include the diagonals inside polygons
+        self.showDiagonals = SHOW_DIAGONALS
 
     def setScene(self, scene):
         '''
@@ -21,54 +88,497 @@ class Camera:
         '''
         self.scene = scene
 
+    def setRasterMode(self, mode):
+        '''
+        Set whether faces are drawn with the Painter's algorithm (PAINTERS) or depth tested (Z_BUFFER)
+        '''
+        if mode not in (PAINTERS, Z_BUFFER):
+            raise ValueError('Invalid raster mode.')
+        self.rasterMode = mode
+
+    def setShadingMode(self, mode):
+        '''
+        Set whether faces are drawn in one colour (FLAT) or blended between their corners (SMOOTH_GOURAUD)
+        '''
+        if mode not in (FLAT, SMOOTH_GOURAUD, SMOOTH_PHONG):
+            raise ValueError('Invalid shading mode.')
+        self.shadingMode = mode
+
+    def setRenderMode(self, mode):
+        '''
+        Set whether faces are drawn SHADED, TEXTURED, or as a WIREFRAME with or without WIREFRAME_DOTS
+        '''
+        if mode not in (WIREFRAME, WIREFRAME_DOTS, SHADED, TEXTURED):
+            raise ValueError('Invalid render mode.')
+        self.renderMode = mode
+
+    def isSmooth(self):
+        '''
+        Check whether faces are Gouraud shaded this frame
+        '''
+        return self.shadingMode == SMOOTH_GOURAUD and self.renderMode == SHADED
+
+    def setWorkers(self, workers):
+        '''
+        Set how many worker processes rasterise the screen tiles in Z_BUFFER mode, 0 to use none
+        '''
+        if workers < 0:
+            raise ValueError('Invalid worker count.')
+        self.close()
+        self.workers = workers
+
+    def close(self):
+        '''
+        Shut down any worker processes the camera started
+        '''
+        if isinstance(self.zBuffer, TiledRasteriser):
+            self.zBuffer.close()
+        self.zBuffer = None
+
+    def setScreen(self, screen):
+        '''
+        Set the surface the camera draws to, such as a subsurface for a split screen viewport
+        '''
+        self.screen = screen
+
+    def getScreenSize(self):
+        return self.screen.get_size()
+
+    def getViewMatrix(self):
+        '''
+        Get the 4x4 matrix which moves world space points into this camera's space
+        '''
+        key = tuple(self.pos)+tuple(self.rot)
+        if key != self._viewKey:
+            self._viewMatrix = getViewMatrix(self.pos, self.rot)
+            self._viewKey = key
+        return self._viewMatrix
+
+    def getProjectionMatrix(self):
+        '''
+        Get the 4x4 matrix which projects this camera's space onto its screen
+        '''
+        key = self.getScreenSize()
+        if key != self._projectionKey:
+            self._projectionMatrix = getProjectionMatrix(key, CAMERA_DEPTH)
+            self._projectionKey = key
+        return self._projectionMatrix
+
+    def getMeshFrame(self, mesh):
+        '''
+        Get the MeshFrame holding this camera's per-frame information for a mesh
+        '''
+        frame = self.meshFrames.get(mesh)
+        if frame is None:
+            frame = MeshFrame(mesh)
+            self.meshFrames[mesh] = frame
+        return frame
+
+    def copy(self):
+        '''
+        Get a new camera with the same position, rotation, screen, scene and settings
+        It has its own per-frame information, so it can prepare a frame while this one is drawn
+        '''
+        cam = Camera(list(self.pos), list(self.rot), self.screen)
+        cam.scene = self.scene
+        cam.rasterMode = self.rasterMode
+        cam.shadingMode = self.shadingMode
+        cam.renderMode = self.renderMode
+        cam.occlusionCulling = self.occlusionCulling
+        cam.showDiagonals = self.showDiagonals
+        # Copies see from the same place, so they share the levels of detail to keep them steady
+        cam.lodLevels = self.lodLevels
+        return cam
+
+    def useFrame(self, other):
+        '''
+        Take the prepared frame of another camera of the same scene, so this camera can draw it
+        '''
+        self.lightState = other.lightState
+        self.frameObjects = other.frameObjects
+        self.frameMeshes = other.frameMeshes
+        self.sortedFaces = other.sortedFaces
+        self.primitiveFrames = other.primitiveFrames
+        self.stageTimes = dict(other.stageTimes)
+        self.counters = dict(other.counters)
+
+    def isVisible(self, bounds):
+        '''
+        Check whether a bounding volume is at least partly inside the view frustum
+        '''
+        if bounds is None:
+            return False
+        low, high, centre, radius = bounds
+        return bool(self.areVisible(np.reshape(centre, (1, 3)), np.array([radius]))[0])
+
+    def areVisible(self, centres, radii):
+        '''
+        Check which of (N, 3) world space spheres with (N,) radii are at least partly inside the view frustum
+        '''
+        x, y, z = applyMatrix(self.getViewMatrix(), centres).T
+
+        # Check the near and far planes
+        visible = (z+radii >= NEAR_CLIP) & (z-radii <= FAR_CLIP)
+
+        # Check the side planes, which come from the projection in Vertex.projectPoint
+        for offset, halfSize in ((x, self.getScreenSize()[0]/2), (y, self.getScreenSize()[1]/2)):
+            slope = halfSize/CAMERA_DEPTH
+            visible &= (np.abs(offset)-z*slope)/math.sqrt(1+slope**2) <= radii
+
+        return visible
+
+    def setShowDiagonals(self, show):
+        '''
+        Set whether wireframes include the edges made inside polygons when they were split into triangles
+        '''
+        self.showDiagonals = show
+
+    def setOcclusionCulling(self, enabled):
+        '''
+        Set whether objects hidden behind occluders are skipped
+        '''
+        self.occlusionCulling = enabled
+
+    def cullOccluded(self, objects):
+        '''
+        Drop the objects which are completely hidden behind the occluders among them
+        Each group's bounds are tested first, so a hidden group's objects don't need testing
+        '''
+        occluders = [obj for obj in objects if obj.occluder]
+        if not occluders:
+            self.depthPyramid = None
+            return objects
+
+        view, projection = self.getViewMatrix(), self.getProjectionMatrix()
+        self.depthPyramid = DepthPyramid(self.getScreenSize())
+        self.depthPyramid.build(np.concatenate([np.zeros((0, 3, 3))]+[obj.mesh.getWorldTriangles() for obj in occluders]),
+                                np.concatenate([np.zeros((0, 2, 3))]+[obj.mesh.getWorldHardEdges() for obj in occluders]), view, projection)
+
+        hidden = {}
+        visible = []
+        for obj in objects:
+            if obj.occluder:
+                visible.append(obj)
+                continue
+            group = obj.parent
+            if group is not None and len(group.objects) > 1:
+                if group not in hidden:
+                    hidden[group] = self.depthPyramid.isOccluded(group.getBounds(), view, projection)
+                if hidden[group]:
+                    continue
+            if not self.depthPyramid.isOccluded(obj.getBounds(), view, projection):
+                visible.append(obj)
+        return visible
+
+    def getProjectedSize(self, bounds):
+        '''
+        Get roughly how many pixels across a bounding volume's sphere is on the screen
+        A sphere around the camera covers the whole screen, so it is infinitely large
+        '''
+        low, high, centre, radius = bounds
+        return float(self.getProjectedSizes(np.reshape(centre, (1, 3)), np.array([radius]))[0])
+
+    def getProjectedSizes(self, centres, radii):
+        '''
+        Get roughly how many pixels across each of (N, 3) world space spheres with (N,) radii is on the screen, see getProjectedSize
+        '''
+        z = applyMatrix(self.getViewMatrix(), centres)[:, 2]
+        sizes = np.full(len(z), math.inf)
+        ahead = z > radii
+        sizes[ahead] = 2*radii[ahead]*CAMERA_DEPTH/np.sqrt(z[ahead]**2-radii[ahead]**2)
+        return sizes
+
+    def timeStage(self, stage, start):
+        '''
+        Add the time since start to one of this frame's stages
+        Returns the current time, to start timing the next stage from
+        '''
+        now = perf_counter()
+        self.stageTimes[stage] += now-start
+        return now
+
+    def count(self, counter, amount):
+        '''
+        Add to one of this frame's counters
+        '''
+        self.counters[counter] += amount
+
+    def addStatsCallback(self, callback):
+        '''
+        Add a function to be called with the stats of every frame once it has been rendered
+        '''
+        self.statsCallbacks.append(callback)
+
+    def removeStatsCallback(self, callback):
+        self.statsCallbacks.remove(callback)
+
+    def getStats(self):
+        '''
+        Get the timings and counters of the last frame
+        '''
+        return {'fps': self.fps,
+                'times': dict(self.stageTimes),
+                'counts': dict(self.counters)
+                }
+
     def addFrameFace(self, face):
         '''
         Add a face to be rendered on this frame only
-        Must be preRendered
+        It is preRendered along with the rest of the frame
         '''
         self.tempFaces.append(face)
+        self.count('tempFaces', 1)
+
+    def addFrameTriangle(self, positions, material, flipped=False, backCull=True):
+        '''
+        Add a triangle with corners at three positions to be rendered on this frame only
+        The triangle comes from a pool, so adding faces every frame doesn't make new objects
+        '''
+        self.addFrameFace(self.facePool.get(positions, material, flipped, backCull))
 
     def preRender(self):
-        for g in range(len(self.scene.groups)):
-            self.scene.groups[g].preRender(self)
+        self.stageTimes = dict.fromkeys(STAGES, 0)
+        # Faces added since the last frame count towards this one
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.counters['tempFaces'] = len(self.tempFaces)
+        start = perf_counter()
 
-        self.sortedFaces = []
-        for group in self.scene.groups:
-            for obj in group.objects:
-                self.sortedFaces += obj.polygons
+        # Objects have to be in place before their shadows, and shadow maps before any lighting is checked
+        self.scene.updateTransforms()
+        self.scene.updateShadows()
+        start = self.timeStage('shade', start)
+        self.lightState = self.scene.getLightState()
+
+        # Skip every group and object which is completely outside the view
+        self.frameObjects = self.scene.getVisibleObjects(self)
+        objectCount = sum(len(group.objects) for group in self.scene.groups)
+        self.count('objects', objectCount)
+        self.count('culledObjects', objectCount-len(self.frameObjects))
+
+        if self.occlusionCulling:
+            visibleCount = len(self.frameObjects)
+            self.frameObjects = self.cullOccluded(self.frameObjects)
+            self.count('occludedObjects', visibleCount-len(self.frameObjects))
+        self.timeStage('cull', start)
+
+        for o in range(len(self.frameObjects)):
+            self.frameObjects[o].preRender(self)
 
-        self.sortedFaces = sorted(self.sortedFaces+self.tempFaces, reverse=True)
+        self.frameMeshes = [self.getMeshFrame(mesh) for obj in self.frameObjects for mesh in obj.getDrawnMeshes(self)]
 
+        start = perf_counter()
+
+        # Collect the depth, owner and row of everything else to draw
+        others = []
+        for obj in self.frameObjects:
+            others += [(prim.getDepth(self), prim, None) for prim in obj.primitives]
+
+        for face in self.tempFaces:
+            face.preRender(self)
+        others += [(face.getDepth(self), face, None) for face in self.tempFaces]
+
+        if self.rasterMode == PAINTERS:
+            for mesh in self.frameMeshes:
+                # Extra faces from clipping are listed after the rows of the visible faces
+                firstExtra = np.count_nonzero(mesh.faceVisible)
+                others += [(mesh.frameDepth[row], mesh, row) for row in range(firstExtra, len(mesh.frameFaces))]
+
+        others.sort(key=itemgetter(0), reverse=True)
+
+        if self.rasterMode == PAINTERS:
+            self.sortedFaces = list(merge(self.sortFaces(), others, key=itemgetter(0), reverse=True))
+        else:
+            self.sortedFaces = others
+
+        # Everything drawn from the temporary faces is kept by this camera now, so they can be reused
+        TrianglePool.release(self.tempFaces)
         self.tempFaces = []
+        self.timeStage('sort', start)
+
+    def sortFaces(self):
+        '''
+        Get the depth, MeshFrame and row of every visible mesh face this frame, from back to front
+        The last frame's order is the starting point, so the sort only has to fix the faces that moved
+        '''
+        meshes = self.frameMeshes
+        if not meshes:
+            return []
+
+        # The depth keys are calculated once per face by the meshes
+        depths = np.concatenate([mesh.faceDepth for mesh in meshes])
+        if meshes != self.orderMeshes or len(self.faceOrder) != len(depths):
+            # The visible meshes have changed, so start from scratch
+            self.orderMeshes = meshes
+            self.faceOrder = np.arange(len(depths))
+
+        # A stable argsort is a timsort, which runs in close to linear time on an almost sorted order
+        self.faceOrder = self.faceOrder[np.argsort(-depths[self.faceOrder], kind='stable')]
+
+        visible = np.concatenate([mesh.faceVisible for mesh in meshes])
+        order = self.faceOrder[visible[self.faceOrder]]
+
+        # Find the mesh and frame row of each face
+        starts = np.cumsum([0]+[len(mesh.faceDepth) for mesh in meshes])
+        meshIndex = np.searchsorted(starts, order, 'right')-1
+        rows = np.concatenate([mesh.faceRows for mesh in meshes])[order]
+
+        return [(depth, meshes[m], row) for depth, m, row in zip(depths[order].tolist(), meshIndex.tolist(), rows.tolist())]
 
     def renderScene(self):
         '''
         Render the scene that this camera is set to render
         '''
-        start = time()
+        start = perf_counter()
 
         if self.scene is None:
             raise ValueError('The scene has not been set for this camera!')
 
-        for face in self.sortedFaces:
-            face.render(self)
+        # Smooth and textured faces are rasterised all at once in the Painter's order, then only outlines are drawn per face
+        batched = self.rasterMode == PAINTERS and (self.isSmooth() or self.renderMode == TEXTURED)
+        outlines = POLY_OUTLINE == HARD_OUTLINE
+        # Wireframes have nothing to hide their edges, so every mesh's edges are drawn at once after everything else
+        wireframe = self.renderMode in (WIREFRAME, WIREFRAME_DOTS)
+
+        if self.rasterMode == Z_BUFFER:
+            self.renderZBuffer()
+        elif batched:
+            self.renderBatched()
+
+        for depth, face, row in self.sortedFaces:
+            if row is None:
+                face.render(self)
+            elif wireframe:
+                continue
+            elif not batched:
+                face.renderFace(self, row)
+            elif outlines:
+                face.renderOutline(self, row)
 
-        if time()-start:
-            self.fps = 1/(time()-start)
+        if wireframe:
+            self.renderWireframe()
 
-    def renderDebug(self):
-        rot = [round(math.degrees(a), 2) for a in self.rot]
-        pos = [round(a, 2) for a in self.pos]
-        font = pygame.font.SysFont(None, 20)
-        text = font.render("Rotation:"+str(rot), True, (0, 0, 255))
-        self.screen.blit(text, [10, 10])
-        text = font.render("Position:"+str(pos), True, (0, 0, 255))
-        self.screen.blit(text, [10, 30])
+        if self.rasterMode == Z_BUFFER:
+            self.count('drawnFaces', sum(len(mesh.frameFaces) for mesh in self.frameMeshes))
+        self.count('drawnFaces', len(self.sortedFaces))
+
+        self.timeStage('raster', start)
+
+        # Include the pre-render stages in the frame time
+        frameTime = sum(self.stageTimes.values())
+        if frameTime:
+            self.fps = 1/frameTime
+
+        if self.statsCallbacks:
+            stats = self.getStats()
+            for callback in self.statsCallbacks:
+                callback(stats)
+
+    def getZBuffer(self):
+        '''
+        Get the buffer faces are rasterised into, making a new one if the screen has changed size
+        '''
+        if self.zBuffer is None or self.zBuffer.size != self.screen.get_size():
+            self.close()
+            if self.workers:
+                self.zBuffer = TiledRasteriser(self.screen.get_size(), self.workers)
+            else:
+                self.zBuffer = ZBuffer(self.screen.get_size())
+        return self.zBuffer
+
+    def renderZBuffer(self):
+        '''
+        Draw the meshes through the depth buffer, which needs no sorting
+        '''
+        zBuffer = self.getZBuffer()
+
+        if self.renderMode in (SHADED, TEXTURED):
+            zBuffer.clear()
+            zBuffer.drawMeshes(self.frameMeshes, self.isSmooth(), self.renderMode == TEXTURED)
+            zBuffer.blit(self.screen)
+
+        # Outlines are drawn over the top, they are not depth tested
+        if POLY_OUTLINE == HARD_OUTLINE and self.renderMode in (SHADED, TEXTURED):
+            for mesh in self.frameMeshes:
+                for row in range(len(mesh.frameFaces)):
+                    mesh.renderOutline(self, row)
+
+    def renderWireframe(self):
+        '''
+        Draw the edges of the visible faces of every mesh after everything else, so edges shared by faces are only drawn once
+        In WIREFRAME_DOTS mode each vertex gets one dot, however many faces it is part of
+        '''
+        if self.renderMode == WIREFRAME_DOTS:
+            for mesh in self.frameMeshes:
+                mesh.renderDots(self)
+
+        for mesh in self.frameMeshes:
+            mesh.renderWireframe(self)
+
+    def renderBatched(self):
+        '''
+        Rasterise the sorted faces with Gouraud shading or textures
+        Each face's place in the Painter's order is used as its depth, so later faces are drawn over earlier ones
+        '''
+        rows = {}
+        for rank, (depth, face, row) in enumerate(self.sortedFaces):
+            if row is not None:
+                rows.setdefault(face, ([], []))
+                rows[face][0].append(row)
+                rows[face][1].append(rank+1)
+        if not rows:
+            return
+
+        frames = list(rows)
+        ranks = np.concatenate([ranks for frameRows, ranks in rows.values()])
+
+        zBuffer = self.getZBuffer()
+        zBuffer.clear()
+        zBuffer.drawMeshes(frames, self.isSmooth(), self.renderMode == TEXTURED, [frameRows for frameRows, ranks in rows.values()], ranks)
+        zBuffer.blit(self.screen)
+
+    def renderOffscreen(self, background=(255, 255, 255)):
+        '''
+        Render a whole frame without needing a display
+        Returns the image as a (height, width, 3) array, the surface is left in self.screen
+        '''
+        self.screen.fill(background)
+        self.preRender()
+        self.renderScene()
+
+        return pygame.surfarray.array3d(self.screen).swapaxes(0, 1)
+
+    def renderDebug(self, showStats=False):
+        '''
+        Draw the camera's rotation and position, and optionally the last frame's stats
+        The text is only redrawn every OVERLAY_INTERVAL seconds, in between the cached overlay is reused
+        '''
+        if self.debugFont is None:
+            self.debugFont = pygame.font.SysFont(None, 20)
+
+        if self.overlay is None or perf_counter()-self.overlayTime > OVERLAY_INTERVAL:
+            rot = [round(math.degrees(a), 2) for a in self.rot]
+            pos = [round(a, 2) for a in self.pos]
+            lines = ["Rotation:"+str(rot), "Position:"+str(pos)]
+
+            if showStats:
+                lines.append("FPS: {:.1f}".format(self.fps))
+                lines += ["{}: {:.2f} ms".format(stage, self.stageTimes[stage]*1000) for stage in STAGES]
+                lines += ["{}: {}".format(counter, self.counters[counter]) for counter in COUNTERS]
+
+            texts = [self.debugFont.render(line, True, (0, 0, 255)) for line in lines]
+            self.overlay = pygame.Surface((max(text.get_width() for text in texts), 20*len(texts)), pygame.SRCALPHA)
+            for t, text in enumerate(texts):
+                self.overlay.blit(text, [0, 20*t])
+            self.overlayTime = perf_counter()
+
+        self.screen.blit(self.overlay, [10, 10])
 
 class Scene:
     def __init__(self):
         self.groups = []
         self.lights = []
+        # The shadow map of each light which casts shadows, by the light's index
+        self.shadowMaps = {}
 
     def addGroup(self, group):
         if isinstance(group, Object):
@@ -85,27 +595,393 @@ class Scene:
         self.lights.append(light)
         return len(self.lights)-1
 
+    def getVisibleObjects(self, cam):
+        '''
+        Get every object which might be seen by the given camera
+        '''
+        objects = []
+        for group in self.groups:
+            objects += group.getVisibleObjects(cam)
+        return objects
+
     def getLights(self):
         return self.lights
 
-class Object:
+    def getShadowMaps(self):
+        '''
+        Get the shadow map of each light, or None for lights which don't cast shadows
+        '''
+        return [self.shadowMaps.get(l) if light.castShadows else None for l, light in enumerate(self.lights)]
+
+    def updateTransforms(self):
+        '''
+        Move every object which it or its group has moved into its new place in world space
+        '''
+        for group in self.groups:
+            for obj in group.objects:
+                obj.updateTransform()
+
+    def getShadowCasters(self):
+        return [obj for group in self.groups for obj in group.objects if obj.castShadows]
+
+    def updateShadows(self):
+        '''
+        Re-render the shadow map of each light which casts shadows, if the light or any shadow casting object has moved
+        Moving only the camera leaves every map as it is
+        '''
+        geometryKey = None
+        for l, light in enumerate(self.lights):
+            if not light.castShadows:
+                continue
+            if geometryKey is None:
+                casters = self.getShadowCasters()
+                geometryKey = tuple((id(obj), obj.mesh.getVersion()) for obj in casters)
+
+            shadowMap = self.shadowMaps.setdefault(l, ShadowMap())
+            key = (light.getState(), geometryKey)
+            if key != shadowMap.key:
+                triangles = [obj.mesh.getWorldTriangles() for obj in casters]
+                shadowMap.render(light, np.concatenate([np.zeros((0, 3, 3))]+triangles), key)
+
+    def snapshot(self):
+        '''
+        Get a copy of the scene which isn't changed by moving its lights or adding to it
+        The objects and shadow maps are shared, their geometry only changes when updateVertices is called
+        '''
+        scene = copy.copy(self)
+        scene.groups = list(self.groups)
+        scene.lights = [copy.deepcopy(light) for light in self.lights]
+        return scene
+
+    def getLightState(self):
+        '''
+        Get a snapshot of the state of every light and its shadow map, to tell when cached lighting is out of date
+        '''
+        shadows = self.getShadowMaps()
+        return tuple((light.getState(), None if shadow is None else shadow.version) for light, shadow in zip(self.lights, shadows))
+
+def combineBounds(boundsList):
+    '''
+    Get the bounding box and sphere containing every one of a list of bounding volumes
+    '''
+    boundsList = [bounds for bounds in boundsList if bounds is not None]
+    if not boundsList:
+        return None
+
+    low = np.min([bounds[0] for bounds in boundsList], axis=0)
+    high = np.max([bounds[1] for bounds in boundsList], axis=0)
+    centre = (low+high)/2
+    radius = max(np.linalg.norm(bounds[2]-centre)+bounds[3] for bounds in boundsList)
+
+    return low, high, centre, radius
+
+class SceneNode:
+    '''
+    Something with a 4x4 model matrix placing it within its parent, the matrices compose down the scene graph
+    '''
+    def __init__(self):
+        self.matrix = np.identity(4)
+        self.parent = None
+
+    def setMatrix(self, matrix):
+        self.matrix = np.array(matrix, dtype=float)
+
+    def setTransform(self, pos=(0, 0, 0), rot=(0, 0, 0), scale=1):
+        '''
+        Set the model matrix from a position, rotation around the x, y and z axes in radians, and scale
+        '''
+        self.setMatrix(getModelMatrix(pos, rot, scale))
+
+    def getWorldMatrix(self):
+        '''
+        Get the matrix which moves this node's space into world space
+        '''
+        if self.parent is None:
+            return self.matrix
+        return self.parent.getWorldMatrix() @ self.matrix
+
+class Object(SceneNode):
     def __init__(self):
+        super().__init__()
         self.polygons = []
+        self.primitives = []
+        self.mesh = Mesh()
+        # Whether the object blocks lights which cast shadows
+        self.castShadows = True
+        # Whether the object hides the objects behind it from occlusion culling, best for large objects like walls
+        self.occluder = False
+
+        self._bounds = None
+        self._boundsKey = None
+        self.boundsVersion = 0
+        # The world matrix the mesh was last moved by
+        self._worldMatrix = np.identity(4)
+        # Simpler meshes drawn in place of the mesh when the object is small on screen, as (mesh, size) from the largest size down
+        self.lods = []
 
     def addPolygon(self, poly):
         self.polygons.append(poly)
+        if isinstance(poly, (NGon, Triangle)):
+            # Faces share the object's vertex buffer
+            self.mesh.addPolygon(poly)
+        else:
+            self.primitives.append(poly)
+
+    def updateVertices(self):
+        '''
+        Rebuild the object's vertex buffer
+        Must be called if the position of a vertex in this object is changed
+        '''
+        self.mesh.update()
+        self._boundsKey = None
+
+    def updateTransform(self):
+        '''
+        Move the mesh into world space if the object or its group has moved since it was last moved
+        Moving an object only changes its matrix, the vertices are moved all at once here
+        '''
+        world = self.getWorldMatrix()
+        if not np.array_equal(world, self._worldMatrix):
+            for mesh in self.getMeshes():
+                mesh.setMatrix(world)
+            self._worldMatrix = world
+
+    def addLOD(self, mesh, size):
+        '''
+        Add a simpler mesh to be drawn in place of the object's own when the object is less than size pixels across on screen
+        The mesh is in the object's space, like the object's own mesh, and is used for drawing only
+        '''
+        mesh.setMatrix(self._worldMatrix)
+        self.lods.append((mesh, size))
+        self.lods.sort(key=itemgetter(1), reverse=True)
+
+    def generateLODs(self, sizes=LOD_SIZES, ratio=None):
+        '''
+        Add a level of detail for each size, each one decimated from the last by decimateMesh
+        Stops early if the mesh can't be made any simpler
+        '''
+        mesh = self.getDetailedMesh()
+        for size in sorted(sizes, reverse=True):
+            simple = decimateMesh(mesh) if ratio is None else decimateMesh(mesh, ratio)
+            if not len(simple.faces) or len(simple.faces) == len(mesh.faces):
+                break
+            self.addLOD(simple, size)
+            mesh = simple
+
+    def getDetailedMesh(self):
+        '''
+        Get the mesh the levels of detail are made from
+        '''
+        return self.mesh
+
+    def getMeshes(self):
+        '''
+        Get the object's mesh and every level of detail
+        '''
+        return [self.mesh]+[mesh for mesh, size in self.lods]
+
+    def selectLOD(self, cam):
+        '''
+        Pick the level of detail to draw the object with from its size on the camera's screen
+        The level only changes once the size is a little past the level's limit, so it doesn't pop back and forth
+        '''
+        level = cam.lodLevels.get(self, 0)
+        if self.lods:
+            level = int(self.pickLevels(np.array([level]), np.array([cam.getProjectedSize(self.getBounds())]))[0])
+        cam.lodLevels[self] = level
+        return level
+
+    def pickLevels(self, levels, sizes):
+        '''
+        Get the level of detail to use for each of an array of projected sizes, given the levels they were last drawn with
+        Level 0 is the full mesh and level l is self.lods[l-1]
+        '''
+        limits = np.array([size for mesh, size in self.lods], dtype=float)
+        # The limits shrink with the level, so the levels a size is small enough to move down to, and too large to move up from,
+        # are both a run from the start
+        lowest = (sizes[:, None] < limits*(1-LOD_HYSTERESIS)).sum(axis=1)
+        highest = (sizes[:, None] <= limits*(1+LOD_HYSTERESIS)).sum(axis=1)
+        return np.minimum(np.maximum(levels, lowest), highest)
+
+    def getMesh(self, cam):
+        '''
+        Get the mesh the camera last picked to draw the object with
+        '''
+        level = cam.lodLevels.get(self, 0)
+        return self.lods[level-1][0] if 0 < level <= len(self.lods) else self.mesh
+
+    def getDrawnMeshes(self, cam):
+        '''
+        Get the meshes the object was last prepared to be drawn with by the camera
+        '''
+        return [self.getMesh(cam)]
+
+    def compact(self):
+        '''
+        Drop the polygons of the object's faces once its mesh is built, see Mesh.compact
+        '''
+        self.mesh.compact()
+        self.polygons = list(self.primitives)
+
+    def getBounds(self):
+        '''
+        Get the bounding box and bounding sphere of the object as (low, high, centre, radius)
+        Returns None if the object has no vertices
+        '''
+        key = (self.mesh.getVersion(), tuple(id(prim) for prim in self.primitives))
+        if key != self._boundsKey:
+            points = [self.mesh.getBoundingPoints()]+[applyMatrix(self.mesh.matrix, np.array([v.pos for v in prim.vertices], dtype=float).reshape(-1, 3)) for prim in self.primitives]
+            points = np.concatenate(points)
+
+            if len(points):
+                low, high = points.min(axis=0), points.max(axis=0)
+                centre = (low+high)/2
+                radius = np.sqrt(((points-centre)**2).sum(axis=1).max())
+                self._bounds = (low, high, centre, radius)
+            else:
+                self._bounds = None
+
+            self._boundsKey = key
+            self.boundsVersion += 1
+
+        return self._bounds
 
     def preRender(self, cam):
-        for p in range(len(self.polygons)):
-            self.polygons[p].preRender(cam)
+        if self.selectLOD(cam):
+            cam.count('reducedObjects', 1)
+        self.getMesh(cam).preRender(cam)
+        for p in range(len(self.primitives)):
+            self.primitives[p].preRender(cam, self.mesh.matrix)
+
+class InstancedObject(Object):
+    '''
+    Many copies of one mesh, each placed within the object by its own matrix and tinted by its own colour
+    The mesh is shared, not copied, so many instanced objects can use the same one
+    '''
+    def __init__(self, mesh):
+        super().__init__()
+        self.mesh = InstanceMesh(mesh)
+
+    def addPolygon(self, poly):
+        raise ValueError('Polygons can\'t be added to an instanced object, add them to its mesh.')
 
-class Group:
+    def setInstances(self, matrices, colours=None):
+        '''
+        Replace every instance with (N, 4, 4) matrices, and (N, 3) colours which default to white
+        '''
+        matrices = np.array(matrices, dtype=float).reshape(-1, 4, 4)
+        if colours is None:
+            colours = np.full((len(matrices), 3), 255.0)
+        for mesh in self.getMeshes():
+            mesh.setInstances(matrices, colours)
+
+    def addInstance(self, matrix, colour=(255, 255, 255)):
+        '''
+        Add an instance to the object and return its index
+        Adding instances rebuilds the whole object, so set them all at once with setInstances where possible
+        '''
+        self.setInstances(np.concatenate([self.mesh.instanceMatrices, [matrix]]), np.concatenate([self.mesh.instanceColours, [colour]]))
+        return len(self.mesh.instanceMatrices)-1
+
+    def setInstance(self, index, matrix=None, colour=None):
+        '''
+        Move or recolour one instance, only that instance's vertices are worked out again
+        '''
+        for mesh in self.getMeshes():
+            mesh.setInstance(index, matrix, colour)
+
+    def getInstanceCount(self):
+        return len(self.mesh.instanceMatrices)
+
+    def updateTransform(self):
+        '''
+        Rebuild the instances if their shared mesh has changed, then move them into world space like any object
+        '''
+        for mesh in self.getMeshes():
+            mesh.checkSource()
+        super().updateTransform()
+
+    def addLOD(self, mesh, size):
+        '''
+        Add a simpler version of the shared mesh, drawn with the same instances when the object is small on screen
+        '''
+        lod = InstanceMesh(mesh)
+        lod.setInstances(self.mesh.instanceMatrices, self.mesh.instanceColours)
+        super().addLOD(lod, size)
+
+    def getDetailedMesh(self):
+        return self.mesh.source
+
+    def selectLOD(self, cam):
+        '''
+        Pick a level of detail for every instance in view from its own size on the camera's screen, see Object.selectLOD
+        Instances outside the view get level -1, and are not drawn
+        Returns the (N,) level of every instance
+        '''
+        centres, radii = self.mesh.getInstanceSpheres()
+        levels = cam.lodLevels.get(self)
+        if levels is None or len(levels) != len(centres):
+            levels = np.full(len(centres), -1)
+
+        visible = cam.areVisible(centres, radii)
+        levels = np.where(visible, np.maximum(levels, 0), -1)
+        if self.lods:
+            levels[visible] = self.pickLevels(levels[visible], cam.getProjectedSizes(centres[visible], radii[visible]))
+        cam.lodLevels[self] = levels
+        return levels
+
+    def getDrawnMeshes(self, cam):
+        '''
+        Get the mesh of every level of detail which the camera last picked for at least one instance
+        '''
+        levels = cam.lodLevels.get(self, np.zeros(0, dtype=int))
+        return [mesh for level, mesh in enumerate(self.getMeshes()) if (levels == level).any()]
+
+    def preRender(self, cam):
+        '''
+        Prepare each instance in view with the level of detail picked for it, so the instances of each level are drawn together
+        Every instance drawn with a simpler mesh counts as a reduced object
+        '''
+        levels = self.selectLOD(cam)
+        cam.count('reducedObjects', int(np.count_nonzero(levels > 0)))
+        for level, mesh in enumerate(self.getMeshes()):
+            instances = np.flatnonzero(levels == level)
+            if len(instances):
+                mesh.preRender(cam, instances)
+
+class Group(SceneNode):
     def __init__(self):
+        super().__init__()
         self.objects = []
 
+        self._bounds = None
+        self._boundsKey = None
+
     def addObject(self, obj):
         self.objects.append(obj)
+        obj.parent = self
 
     def preRender(self, cam):
         for o in range(len(self.objects)):
             self.objects[o].preRender(cam)
+
+    def getBounds(self):
+        '''
+        Get the bounding box and bounding sphere of every object in the group
+        '''
+        bounds = [obj.getBounds() for obj in self.objects]
+        key = tuple((id(obj), obj.boundsVersion) for obj in self.objects)
+        if key != self._boundsKey:
+            self._bounds = combineBounds(bounds)
+            self._boundsKey = key
+        return self._bounds
+
+    def getVisibleObjects(self, cam):
+        '''
+        Get every object in the group which might be seen by the given camera
+        '''
+        if not cam.isVisible(self.getBounds()):
+            return []
+        if len(self.objects) == 1:
+            return list(self.objects)
+        return [obj for obj in self.objects if cam.isVisible(obj.getBounds())]
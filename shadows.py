@@ -0,0 +1,142 @@
+import numpy as np
+
+from math_helper import *
+from clipping import *
+from rasteriser import ZBuffer
+
+# The width and height of every shadow map, point lights have six of them
+SHADOW_MAP_SIZE = 512
+# How far behind the nearest surface to a light a position must be to be in shadow, as a fraction of its depth
+SHADOW_BIAS = 0.02
+# The closest and furthest a surface can be from a point light and still cast a shadow
+SHADOW_NEAR_CLIP = 0.01
+SHADOW_FAR_CLIP = 1e9
+
+# The forward and up directions of the six faces of a point light's cube map
+CUBE_FACES = (([1, 0, 0], [0, 1, 0]), ([-1, 0, 0], [0, 1, 0]),
+              ([0, 1, 0], [0, 0, -1]), ([0, -1, 0], [0, 0, 1]),
+              ([0, 0, 1], [0, 1, 0]), ([0, 0, -1], [0, 1, 0]))
+
+def getBasis(forward, up):
+    '''
+    Get the matrix which rotates a world space vector into a view looking along forward
+    The rows are the view's right, up and forward directions
+    '''
+    forward = normaliseAll(np.array(forward, dtype=float))
+    right = normaliseAll(np.cross(up, forward))
+    if not right.any():
+        # Looking straight along the up direction, so any sideways direction will do
+        right = normaliseAll(np.cross([0, 0, 1], forward))
+    return np.array([right, np.cross(forward, right), forward])
+
+class ShadowMap:
+    '''
+    Depth maps of the scene rendered from a light, used to tell which positions the light can't reach
+    Directional lights use one orthographic map, point lights use a cube map of six perspective ones
+    '''
+    def __init__(self, size=SHADOW_MAP_SIZE):
+        self.size = size
+        self.key = None
+        self.version = 0
+
+        self.point = False
+        self.pos = np.zeros(3)
+        self.bases = []
+        self.buffers = []
+
+        # The area of an orthographic map, in the light's view space
+        self.low = np.zeros(3)
+        self.high = np.zeros(3)
+
+    def render(self, light, triangles, key):
+        '''
+        Render the (T, 3, 3) world space triangles from the light
+        The key is kept to tell when the light or geometry has moved since
+        '''
+        self.key = key
+        self.version += 1
+
+        self.point = not hasattr(light, 'rot')
+        if self.point:
+            self.pos = np.array(light.pos, dtype=float)
+            self.bases = [getBasis(forward, up) for forward, up in CUBE_FACES]
+        else:
+            # Directional light travels along its offset, from the light towards the lit position
+            self.bases = [getBasis(light.getOffset(), [0, 1, 0])]
+        self.buffers = [ZBuffer((self.size, self.size)) for basis in self.bases]
+
+        if not len(triangles):
+            return
+
+        if self.point:
+            # Each face of the cube has a 90 degree view, like a camera with a depth of half the map size
+            planes = getClipPlanes(SHADOW_NEAR_CLIP, SHADOW_FAR_CLIP, (self.size, self.size), self.size/2)
+            relative = triangles-self.pos
+            for basis, buffer in zip(self.bases, self.buffers):
+                local = relative @ basis.T
+                rejected, crossing = classifyFaces(local, planes)
+                polys, counts = clipPolygons(local[~rejected], planes)
+                local, owner, fanIndex = triangulateFans(polys, counts)
+
+                buffer.drawTriangles(self._project(local), 1/local[:, :, 2], np.zeros((len(local), 3)))
+        else:
+            local = triangles @ self.bases[0].T
+            self.low = local.reshape(-1, 3).min(axis=0)
+            self.high = local.reshape(-1, 3).max(axis=0)
+
+            # The key has to be larger for closer surfaces and linear across the map, so use the distance from the back
+            self.buffers[0].drawTriangles(self._project(local), self.high[2]+1-local[:, :, 2], np.zeros((len(local), 3)))
+
+    def _project(self, local):
+        '''
+        Get the map position of points in the light's view space
+        '''
+        if self.point:
+            return self.size/2 + np.stack([local[..., 0], -local[..., 1]], axis=-1)*(self.size/2)/local[..., 2:]
+
+        extent = np.maximum(self.high[:2]-self.low[:2], 1e-9)
+        return (local[..., :2]-self.low[:2])/extent*(self.size-1)
+
+    def getVisibility(self, points):
+        '''
+        Get how much of the light reaches each of an (N, 3) array of world positions, 1 if it is lit or 0 if in shadow
+        '''
+        visibility = np.ones(len(points))
+        if not self.buffers:
+            return visibility
+
+        if self.point:
+            # Look each point up in the cube face it is in front of
+            relative = points-self.pos
+            faces = np.array([basis[2] for basis in self.bases]) @ relative.T
+            face = np.argmax(faces, axis=0)
+            for f, (basis, buffer) in enumerate(zip(self.bases, self.buffers)):
+                picked = np.flatnonzero(face == f)
+                local = relative[picked] @ basis.T
+                depth = local[:, 2]
+                visibility[picked] = self._lookup(buffer, self._project(local), 1/np.maximum(depth, SHADOW_NEAR_CLIP), depth*SHADOW_BIAS, True)
+        else:
+            local = points @ self.bases[0].T
+            bias = SHADOW_BIAS*max(self.high-self.low)
+            visibility = self._lookup(self.buffers[0], self._project(local), self.high[2]+1-local[:, 2], bias, False)
+
+        return visibility
+
+    def _lookup(self, buffer, mapPos, keys, bias, perspective):
+        '''
+        Compare keys against the depth map, positions off the edge of the map are lit
+        '''
+        mapPos = np.floor(mapPos).astype(int)
+        inside = ((mapPos >= 0) & (mapPos < self.size)).all(axis=1)
+        stored = np.zeros(len(keys))
+        stored[inside] = buffer.depth[mapPos[inside, 0], mapPos[inside, 1]]
+
+        # Convert both keys back to distances from the light to apply the bias
+        if perspective:
+            nearest = np.divide(1, stored, out=np.full(len(keys), np.inf), where=stored > 0)
+            depth = 1/keys
+        else:
+            nearest = np.where(stored > 0, self.high[2]+1-stored, np.inf)
+            depth = self.high[2]+1-keys
+
+        return (nearest >= depth-bias).astype(float)
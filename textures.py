@@ -0,0 +1,75 @@
+import pygame
+import numpy as np
+
+# Every texture loaded so far, by file path or by the id of the surface it came from
+TEXTURE_CACHE = {}
+
+class Texture:
+    '''
+    An image held as an array, along with mip levels which each halve the size of the last
+    Arrays are indexed [x, y] to match pygame.surfarray
+    '''
+    def __init__(self, pixels):
+        self.levels = [np.ascontiguousarray(pixels, dtype=np.uint8)]
+        while self.levels[-1].shape[0] > 1 or self.levels[-1].shape[1] > 1:
+            self.levels.append(downsample(self.levels[-1]))
+
+        self.size = self.levels[0].shape[:2]
+
+    def getLevels(self, uvs, screenPos):
+        '''
+        Choose the mip level for (K, 3, 2) texture coordinates drawn at (K, 3, 2) screen positions
+        The level is the one where one texel covers about one pixel
+        '''
+        def doubleArea(points):
+            a, b, c = points[:, 0], points[:, 1], points[:, 2]
+            return np.abs((b[:, 0]-a[:, 0])*(c[:, 1]-a[:, 1]) - (b[:, 1]-a[:, 1])*(c[:, 0]-a[:, 0]))
+
+        texels = doubleArea(uvs)*self.size[0]*self.size[1]
+        pixels = np.maximum(doubleArea(np.asarray(screenPos, dtype=float)), 1)
+        level = np.floor(0.5*np.log2(np.maximum(texels/pixels, 1)))
+
+        return np.minimum(level, len(self.levels)-1).astype(int)
+
+    def sample(self, u, v, levels):
+        '''
+        Get the colours of the texture at arrays of coordinates, each from its own mip level
+        Coordinates outside of 0 to 1 wrap around
+        '''
+        colours = np.zeros((len(u), 3), dtype=np.uint8)
+        for level in np.unique(levels):
+            pixels = self.levels[level]
+            picked = np.flatnonzero(levels == level)
+            # Floor rather than truncate, so negative coordinates wrap to the same texels as positive ones
+            x = np.floor(u[picked]*pixels.shape[0]).astype(int) % pixels.shape[0]
+            y = np.floor(v[picked]*pixels.shape[1]).astype(int) % pixels.shape[1]
+            colours[picked] = pixels[x, y]
+        return colours
+
+def downsample(pixels):
+    '''
+    Halve the size of an image by averaging blocks of pixels, an odd row or column is repeated
+    '''
+    for axis in (0, 1):
+        if pixels.shape[axis] > 1 and pixels.shape[axis] % 2:
+            pixels = np.concatenate([pixels, pixels.take([-1], axis=axis)], axis=axis)
+
+    w, h = pixels.shape[:2]
+    fx, fy = min(w, 2), min(h, 2)
+    blocks = pixels.reshape(w//fx, fx, h//fy, fy, 3).astype(np.uint16)
+
+    return (blocks.sum(axis=(1, 3))//(fx*fy)).astype(np.uint8)
+
+def loadTexture(image):
+    '''
+    Get the texture of an image file path or pygame Surface
+    Each image is only loaded and mip mapped the first time it is used
+    '''
+    key = image if isinstance(image, str) else id(image)
+    cached = TEXTURE_CACHE.get(key)
+    if cached is None:
+        surface = pygame.image.load(image) if isinstance(image, str) else image
+        # Keep hold of the image too, so its id isn't reused while it is cached
+        cached = (image, Texture(pygame.surfarray.array3d(surface)))
+        TEXTURE_CACHE[key] = cached
+    return cached[1]